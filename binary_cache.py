@@ -0,0 +1,239 @@
+import hashlib
+import os
+import subprocess
+import threading
+import time
+from constants import (
+    BINARY_CACHE_BUDGET_MB,
+    BINARY_CACHE_DIR,
+    REPO_PATH,
+    SERVICE_DIR,
+    TEST_DIR,
+    TEST_ENV_PARAMS,
+)
+
+MODULE_FILES = ("go.mod", "go.sum")
+
+
+class TestBinaryCache:
+    """Content-addressed cache of per-service `go test -c` binaries.
+
+    A binary is keyed by a hash of the sources of the service package and of
+    every package of the module it depends on (`go list -deps -test`), plus
+    go.mod and go.sum. It is rebuilt when that key changes, and evicted
+    least-recently-used first once the cache grows past its disk budget. A
+    failed build is remembered per key, so the tests of a broken service do
+    not rebuild it one after the other.
+    """
+
+    def __init__(self, cache_dir=BINARY_CACHE_DIR, budget_mb=BINARY_CACHE_BUDGET_MB):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.budget = budget_mb * 1024 * 1024
+        self.keys = {}
+        self.package_dirs = {}
+        self.dir_digests = {}
+        self.dir_stamps = {}
+        self.module_stamp = None
+        self.failed = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def package_path(self, service_name):
+        return f"{SERVICE_DIR}/{service_name}"
+
+    def get_package_dirs(self, service_name):
+        # standard and vendored packages are covered by go.mod and go.sum
+        module_path = os.path.abspath(REPO_PATH)
+        vendor_path = os.path.join(module_path, "vendor")
+        package_dirs = {os.path.abspath(self.package_path(service_name))}
+        result = subprocess.run(
+            [
+                "go",
+                "list",
+                "-deps",
+                "-test",
+                "-f",
+                "{{if not .Standard}}{{.Dir}}{{end}}",
+                f"{TEST_DIR}/{service_name}/",
+            ],
+            env=TEST_ENV_PARAMS,
+            cwd=REPO_PATH,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+        if result.returncode == 0:
+            for line in result.stdout.splitlines():
+                if line.startswith(module_path + os.sep) and not line.startswith(
+                    vendor_path + os.sep
+                ):
+                    package_dirs.add(line)
+        return sorted(package_dirs)
+
+    def get_stamp(self, path, filenames=None):
+        # names, mtimes and sizes of the Go files (or the given files) of a
+        # directory, cheap enough to compare on every watch
+        try:
+            return sorted(
+                (entry.name, entry.stat().st_mtime_ns, entry.stat().st_size)
+                for entry in os.scandir(path)
+                if (
+                    entry.name in filenames if filenames else entry.name.endswith(".go")
+                )
+            )
+        except FileNotFoundError:
+            return None
+
+    def get_dir_digest(self, path):
+        # every service depends on the shared packages, hash them only once
+        if path in self.dir_digests:
+            return self.dir_digests[path]
+        # stamped first, so a write while hashing shows up as a change
+        self.dir_stamps[path] = self.get_stamp(path)
+        digest = hashlib.sha256()
+        for filename in sorted(os.listdir(path)):
+            if not filename.endswith(".go"):
+                continue
+            digest.update(filename.encode())
+            with open(f"{path}/{filename}", "rb") as file:
+                digest.update(file.read())
+        self.dir_digests[path] = digest.digest()
+        return digest.digest()
+
+    def get_key(self, service_name):
+        key = self.keys.get(service_name)
+        if key:
+            return key
+        digest = hashlib.sha256()
+        module_path = os.path.abspath(REPO_PATH)
+        if self.module_stamp is None:
+            self.module_stamp = self.get_stamp(module_path, MODULE_FILES)
+        package_dirs = self.get_package_dirs(service_name)
+        self.package_dirs[service_name] = set(package_dirs)
+        for path in package_dirs:
+            digest.update(os.path.relpath(path, module_path).encode())
+            digest.update(self.get_dir_digest(path))
+        for filename in MODULE_FILES:
+            path = f"{REPO_PATH}/{filename}"
+            if os.path.exists(path):
+                with open(path, "rb") as file:
+                    digest.update(file.read())
+        self.keys[service_name] = digest.hexdigest()[:16]
+        return digest.hexdigest()[:16]
+
+    def invalidate_changed(self):
+        """Drops the memoized keys of the services whose sources changed
+        since they were hashed, and returns those services."""
+        module_path = os.path.abspath(REPO_PATH)
+        if self.module_stamp is not None and self.module_stamp != self.get_stamp(
+            module_path, MODULE_FILES
+        ):
+            services = list(self.keys)
+            self.keys.clear()
+            self.package_dirs.clear()
+            self.dir_digests.clear()
+            self.dir_stamps.clear()
+            self.module_stamp = None
+            return services
+        changed = {
+            path
+            for path, stamp in list(self.dir_stamps.items())
+            if self.get_stamp(path) != stamp
+        }
+        for path in changed:
+            self.dir_digests.pop(path, None)
+            self.dir_stamps.pop(path, None)
+        services = [
+            service_name
+            for service_name, package_dirs in list(self.package_dirs.items())
+            if package_dirs & changed
+        ]
+        for service_name in services:
+            self.keys.pop(service_name, None)
+            self.package_dirs.pop(service_name, None)
+        return services
+
+    def get_lock(self, service_name):
+        with self.lock:
+            return self.locks.setdefault(service_name, threading.Lock())
+
+    def binary_path(self, service_name):
+        return f"{self.cache_dir}/{service_name}-{self.get_key(service_name)}.test"
+
+    def get(self, service_name):
+        with self.get_lock(service_name):
+            binary = self.binary_path(service_name)
+            if self.failed.get(service_name) == binary:
+                return None
+            try:
+                os.utime(binary)
+                return binary
+            except FileNotFoundError:
+                # not built yet, or evicted for another service
+                pass
+            if self.build(service_name, binary):
+                self.remove_stale(service_name, binary)
+                self.evict(keep=binary)
+                return binary
+            self.failed[service_name] = binary
+        return None
+
+    def build(self, service_name, binary):
+        print(f"Building test binary for {service_name}...")
+        build_start = time.time()
+        partial = f"{binary}.partial"
+        result = subprocess.run(
+            ["go", "test", "-c", "-o", partial, f"{TEST_DIR}/{service_name}/"],
+            env=TEST_ENV_PARAMS,
+            cwd=REPO_PATH,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+        )
+        # a package without tests builds nothing and still exits with 0
+        if result.returncode != 0 or not os.path.exists(partial):
+            print(f"Building test binary for {service_name} failed:\n{result.stdout}")
+            return False
+        os.replace(partial, binary)
+        build_duration = time.strftime(
+            "%Mm %Ss", time.gmtime(time.time() - build_start)
+        )
+        print(f"Built test binary for {service_name} in {build_duration}.")
+        return True
+
+    def remove_stale(self, service_name, binary):
+        for entry in os.scandir(self.cache_dir):
+            if entry.path != binary and entry.name.rsplit("-", 1)[0] == service_name:
+                remove_file(entry.path)
+
+    def evict(self, keep):
+        # other services build and evict concurrently under their own locks,
+        # so any entry may disappear while this runs
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(".test"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.budget:
+                break
+            if path == keep:
+                continue
+            total -= size
+            if remove_file(path):
+                print(f"Evicted test binary {os.path.basename(path)}")
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return False
+    return True
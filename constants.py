@@ -3,16 +3,37 @@ import os
 
 ROOT_DIR = "."
 PICKLE_TEST_DETAILS_FILE = f"{ROOT_DIR}/save.pickle"
+RESULT_STORE_FILE = f"{ROOT_DIR}/results.db"
 TEST_LIST_FILE = f"{ROOT_DIR}/test-list.yaml"
 TEST_REPORT_FILENAME = f"{ROOT_DIR}/report.html"
+TEST_REPORT_DATA_FILENAME = f"{ROOT_DIR}/report.json"
+TEST_REPORT_SCRIPT_FILENAME = f"{ROOT_DIR}/report.js"
+TRACE_FILE = f"{ROOT_DIR}/trace.json"
+TEST_REPORT_TEMPLATE = os.path.join(os.path.dirname(__file__), "etc/report/report.html")
 LOG_PATH = f"{ROOT_DIR}/logs"
+# "gzip" or "none"; a cap of 0 keeps the whole log
+LOG_COMPRESSION = "gzip"
+LOG_COMPRESS_LEVEL = 6
+LOG_MAX_MB = 0
+DISCOVERY_INDEX_FILE = f"{ROOT_DIR}/discovery.pickle"
+BINARY_CACHE_DIR = f"{ROOT_DIR}/.cache/bin"
+BINARY_CACHE_BUDGET_MB = 4096
 
 GO_TEST_REGEX = "^func TestAcc(.*)$"
 GO_PATTERN = re.compile(GO_TEST_REGEX)
+GO_FILE_PATTERN = re.compile(GO_TEST_REGEX.encode(), re.MULTILINE)
 
 REPO_PATH="./terraform-provider-aws"
 TEST_DIR = "./internal/service"
-TEST_DIR_REGEX = f"{REPO_PATH}/internal/service/**/*_test.go"
+SERVICE_DIR = f"{REPO_PATH}/internal/service"
+TEST_DIR_REGEX = f"{SERVICE_DIR}/**/*_test.go"
+TEST_FILE_SUFFIX = "_test.go"
+# changes to these affect every test of the provider
+GO_MODULE_FILES = ["go.mod", "go.sum"]
+SCRAPE_JOBS = os.cpu_count() or 1
+# test packages compiled concurrently before a run; `go build` already uses
+# every core for a single package, so a few at a time is enough
+WARMUP_JOBS = min(4, os.cpu_count() or 1)
 
 TEST_ENV_PARAMS = {
     'AWS_DEFAULT_REGION': 'us-east-1',
@@ -29,11 +50,83 @@ TEST_ARG_PARAMS = {
 }
 
 GO_TEST_CMD = "go test"
+GO_TOOL_TEST2JSON_CMD = "go tool test2json -t -p"
+GO_TEST_PREFIX = "TestAcc"
+BATCH_PARALLEL = 4
 
 LOCALSTACK_ENDPOINT = "http://localhost:4566"
+HEALTH_CHECK_TIMEOUT = 5
+# seconds between health checks of a LocalStack endpoint pool
+HEALTH_CHECK_INTERVAL = 5
+HEALTH_CHECK_RETRIES = 1
+# seconds a run keeps polling a LocalStack that is not up yet, while the
+# test packages compile
+HEALTH_WAIT_TIMEOUT = 60
+# environment variables pointing a test at the endpoint it was assigned, read
+# by the provider patch in etc/tf-patch; S3 gets its own virtual-host endpoint
+ENDPOINT_ENV_VARS = ["AWS_ENDPOINT_URL"]
+ENDPOINT_S3_ENV_VAR = "AWS_ENDPOINT_URL_S3"
+LOCALSTACK_S3_HOST = "s3.localhost.localstack.cloud"
 SERVICES_TO_TEST = ["ec2", "route53", "route53resolver", "s3"]
 
+# control socket of `goat serve`, and how often it polls the provider tree
+DAEMON_SOCKET = f"{ROOT_DIR}/goat.sock"
+WATCH_INTERVAL = 2
+
 HTTP_SERVER_HOST = "localhost"
 HTTP_SERVER_PORT = 8000
+# text files up to this size are gzip-encoded on the fly by the report server
+REPORT_SERVER_GZIP_MAX_MB = 16
+
+PROCESS_POOL = {}
+POOL_PROCESSES = 8
+
+SEARCH_MODES = ["substring", "prefix", "regex"]
+
+# seconds assumed for tests that have never been run
+DEFAULT_TEST_DURATION = 120
+DURATION_HISTORY_SIZE = 10
+
+# per-test timeouts from duration history: the TIMEOUT_PERCENTILE of recorded
+# durations times TIMEOUT_MULTIPLIER, kept within floor and ceiling (seconds);
+# tests without history only get the `-timeout` of TEST_ARG_PARAMS
+TIMEOUT_PERCENTILE = 95
+TIMEOUT_MULTIPLIER = 3
+TIMEOUT_FLOOR = 60
+TIMEOUT_CEILING = 600
+
+# the circuit breaker stops a service after this many failures in a row, or
+# once at least BREAKER_MIN_TESTS ran and BREAKER_FAILURE_RATE of them failed
+BREAKER_CONSECUTIVE_FAILURES = 5
+BREAKER_FAILURE_RATE = 0.8
+BREAKER_MIN_TESTS = 10
+
+# `trends` compares the last run against the TREND_WINDOW runs before it and
+# flags tests and services that got at least TREND_MIN_RATIO times slower
+# with a one-sided significance below TREND_ALPHA
+TREND_WINDOW = 10
+TREND_MIN_RATIO = 1.5
+TREND_ALPHA = 0.05
+TREND_MIN_SAMPLES = 3
+# modified z-score above which a single duration is an outlier of its history
+TREND_OUTLIER_SCORE = 3.5
+SPARKLINE_SIZE = 20
+
+# failed tests are retried up to this many times within a run
+RETRY_BUDGET = 0
+# tests that flaked (failed, then passed on retry) in this many of the last
+# QUARANTINE_WINDOW runs are quarantined: run last, QUARANTINE_PROCESSES at a time
+QUARANTINE_THRESHOLD = 2
+QUARANTINE_WINDOW = 10
+QUARANTINE_PROCESSES = 1
+QUARANTINE_GROUP = "quarantine"
 
-PROCESS_POOL = {}
\ No newline at end of file
+# bounds and thresholds of the adaptive concurrency controller
+ADAPTIVE_MIN_PROCESSES = 2
+ADAPTIVE_MAX_PROCESSES = 16
+ADAPTIVE_INTERVAL = 10
+ADAPTIVE_LOAD_LOW = 0.7
+ADAPTIVE_LOAD_HIGH = 1.5
+ADAPTIVE_MEMORY_LOW_MB = 1024
+ADAPTIVE_LATENCY_LOW = 0.2
+ADAPTIVE_LATENCY_HIGH = 1.0
@@ -0,0 +1,433 @@
+import itertools
+import json
+import os
+import queue
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+from colorama import Fore
+from constants import (
+    DAEMON_SOCKET,
+    POOL_PROCESSES,
+    SERVICE_DIR,
+    TEST_ENV_PARAMS,
+    WARMUP_JOBS,
+    WATCH_INTERVAL,
+)
+from discovery import DiscoveryIndex
+from log_writer import open_log
+from models import RunOptions, TestDetail, TestSummary
+from scheduler import Scheduler
+from utils import check_health_status, format_seconds
+from warmup import Warmup
+
+FINISHED_STATES = ("passed", "failed", "cancelled", "error")
+
+
+class JobOutput:
+    """Lines printed while a job ran, which clients can follow live."""
+
+    def __init__(self):
+        self.lines = []
+        self.done = False
+        self.condition = threading.Condition()
+
+    def append(self, line):
+        with self.condition:
+            self.lines.append(line)
+            self.condition.notify_all()
+
+    def finish(self):
+        with self.condition:
+            self.done = True
+            self.condition.notify_all()
+
+    def follow(self):
+        index = 0
+        while True:
+            with self.condition:
+                while index >= len(self.lines) and not self.done:
+                    self.condition.wait()
+                lines = self.lines[index:]
+                done = self.done
+            index += len(lines)
+            yield from lines
+            if done and index >= len(self.lines):
+                return
+
+
+class OutputTee:
+    # stands in for sys.stdout: whatever any thread prints while a job runs
+    # also goes to the job's output, one complete line at a time, except
+    # for threads named with one of the `background` prefixes
+    def __init__(self, stream, background=()):
+        self.stream = stream
+        self.background = tuple(background)
+        self.output = None
+        self.partial = {}
+        self.lock = threading.Lock()
+
+    def attach(self, output):
+        with self.lock:
+            self.partial.clear()
+            self.output = output
+
+    def write(self, data):
+        self.stream.write(data)
+        output = self.output
+        if output is None or (
+            self.background
+            and threading.current_thread().name.startswith(self.background)
+        ):
+            return len(data)
+        with self.lock:
+            key = threading.get_ident()
+            *lines, rest = (self.partial.pop(key, "") + data).split("\n")
+            if rest:
+                self.partial[key] = rest
+        for line in lines:
+            output.append(line)
+        return len(data)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class Job:
+    def __init__(self, job_id, request):
+        self.job_id = job_id
+        self.request = request
+        self.state = "queued"
+        self.cancelled = False
+        self.output = JobOutput()
+        self.total = self.passed = self.failed = 0
+        self.start_time = self.end_time = None
+
+    def count(self, test_details):
+        # tests the job never started still hold the results of earlier runs,
+        # and those it cancelled were not recorded
+        ran = [
+            test_detail
+            for test_detail in test_details
+            if test_detail.start_time
+            and test_detail.start_time >= self.start_time
+            and not test_detail.aborted
+        ]
+        self.total = len(test_details)
+        self.passed = sum(1 for test_detail in ran if test_detail.return_code == 0)
+        self.failed = len(ran) - self.passed
+
+    def to_dict(self):
+        return {
+            "job": self.job_id,
+            "state": self.state,
+            "request": self.request,
+            "total": self.total,
+            "passed": self.passed,
+            "failed": self.failed,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+        }
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    # one JSON request per connection, answered by JSON lines
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            for message in self.server.goat.handle(request):
+                self.send(message)
+        except (BrokenPipeError, ConnectionResetError):
+            # the client went away, a running job carries on
+            pass
+        except Exception as e:
+            self.send({"error": str(e)})
+
+    def send(self, message):
+        self.wfile.write((json.dumps(message) + "\n").encode())
+        self.wfile.flush()
+
+
+class GoatDaemon:
+    """Long-lived runner serving requests over a Unix domain socket.
+
+    The result store, the discovery index, the scheduler and the test
+    binary cache stay resident, so a request only pays for the tests it
+    runs. Run requests queue up and execute one at a time; a client can
+    follow a job's output, cancel it, or ask for status and test logs. The
+    provider tree is polled every `watch_interval` seconds: changed test
+    files are synced into the store, cached binaries whose sources changed
+    are dropped, and the affected packages are warmed up again.
+    """
+
+    def __init__(
+        self,
+        socket_path=DAEMON_SOCKET,
+        jobs=POOL_PROCESSES,
+        binary_cache=None,
+        log_policy=None,
+        warmup_jobs=WARMUP_JOBS,
+        watch_interval=WATCH_INTERVAL,
+    ):
+        self.socket_path = socket_path
+        self.binary_cache = binary_cache
+        self.log_policy = log_policy
+        self.warmup_jobs = warmup_jobs
+        self.watch_interval = watch_interval
+        self.summary = TestSummary(scheduler=Scheduler(processes=jobs))
+        self.discovery_index = DiscoveryIndex()
+        self.jobs = {}
+        self.job_ids = itertools.count(1)
+        self.queue = queue.Queue()
+        self.current = None
+        # the watcher and the warm-ups it starts are not part of any job
+        self.tee = OutputTee(sys.stdout, background=("watch", "warmup-"))
+        self.stopped = threading.Event()
+        self.start_time = time.time()
+        self.last_refresh = None
+        self.server = None
+
+    def refresh(self):
+        changed, removed = self.discovery_index.refresh(jobs=1)
+        self.last_refresh = time.time()
+        services = {path.split("/")[-2] for path in changed}
+        if changed or removed:
+            self.summary.sync_discovery(self.discovery_index)
+            print(
+                f"{Fore.CYAN}[WATCH]   :: {len(changed)} test files changed, {len(removed)} removed"
+            )
+        if self.binary_cache:
+            # sources and shared packages are not test files, the cache
+            # checks the directories its keys were hashed from instead
+            stale = self.binary_cache.invalidate_changed()
+            if stale:
+                print(
+                    f"{Fore.CYAN}[WATCH]   :: sources of {len(stale)} services changed"
+                )
+            services.update(stale)
+        if services and self.warmup_jobs > 0:
+            Warmup(sorted(services), self.warmup_jobs, self.binary_cache).start()
+
+    def watch(self):
+        while not self.stopped.wait(self.watch_interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"{Fore.RED}[WATCH]   :: refresh failed: {e}")
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            if job.state == "queued":
+                self.run_job(job)
+
+    def run_job(self, job):
+        self.current = job
+        job.state = "running"
+        job.start_time = time.time()
+        self.tee.attach(job.output)
+        try:
+            if not check_health_status():
+                print("Localstack is not running. Please start localstack first.")
+                job.state = "failed"
+            else:
+                self.summary.local(
+                    job.request.get("pattern"),
+                    job.request.get("mode") or "substring",
+                    job.request.get("service_name"),
+                    RunOptions(
+                        binary_cache=self.binary_cache, log_policy=self.log_policy
+                    ),
+                )
+                job.count(list(self.summary.test_details.values()))
+                if job.cancelled:
+                    job.state = "cancelled"
+                else:
+                    job.state = "failed" if job.failed else "passed"
+        except (Exception, SystemExit) as e:
+            print(f"Exception - job #{job.job_id} failed due to : {e}")
+            job.state = "error"
+        job.end_time = time.time()
+        self.tee.attach(None)
+        color = Fore.GREEN if job.state == "passed" else Fore.RED
+        print(f"{color}[JOB]     :: {format_job(job.to_dict())}")
+        job.output.finish()
+        self.current = None
+
+    def submit(self, request):
+        if not request.get("pattern") and not request.get("service_name"):
+            raise Exception("A run needs a pattern or a service name")
+        job = Job(next(self.job_ids), request)
+        self.jobs[job.job_id] = job
+        self.queue.put(job)
+        return job
+
+    def get_job(self, job_id=None):
+        if job_id is not None:
+            if int(job_id) not in self.jobs:
+                raise Exception(f"No job #{job_id}")
+            return self.jobs[int(job_id)]
+        if self.current:
+            return self.current
+        if not self.jobs:
+            raise Exception("No jobs yet")
+        return self.jobs[max(self.jobs)]
+
+    def cancel(self, job_id=None):
+        job = self.get_job(job_id)
+        if job.state == "queued":
+            job.state = "cancelled"
+            job.output.finish()
+        elif job.state == "running":
+            job.cancelled = True
+            self.summary.abort()
+        return job
+
+    def get_status(self):
+        return {
+            "pid": os.getpid(),
+            "uptime": time.time() - self.start_time,
+            "test_files": len(self.discovery_index.entries),
+            "last_refresh": self.last_refresh,
+            "current": self.current.job_id if self.current else None,
+            "queued": sum(1 for job in self.jobs.values() if job.state == "queued"),
+            "jobs": [self.jobs[job_id].to_dict() for job_id in sorted(self.jobs)],
+        }
+
+    def read_test_log(self, test_name, service_name=None, stream="stdout"):
+        if not service_name:
+            rows = self.summary.store.query(
+                "SELECT service_name FROM tests WHERE test_name = ?", (test_name,)
+            )
+            if not rows:
+                raise Exception(f"No test {test_name}")
+            service_name = rows[0]["service_name"]
+        test_detail = TestDetail(service_name, test_name)
+        path = test_detail.stderr_log if stream == "stderr" else test_detail.stdout_log
+        for candidate in (path, f"{path}.gz"):
+            if os.path.exists(candidate):
+                with open_log(candidate) as file:
+                    for line in file:
+                        yield line.decode(errors="replace").rstrip("\n")
+                return
+        raise Exception(f"No {stream} log for {service_name}/{test_name}")
+
+    def handle(self, request):
+        op = request.get("op")
+        if op == "status":
+            yield self.get_status()
+        elif op == "run":
+            job = self.submit(request)
+            yield job.to_dict()
+            if request.get("follow"):
+                for line in job.output.follow():
+                    yield {"line": line}
+                yield job.to_dict()
+        elif op == "cancel":
+            yield self.cancel(request.get("job")).to_dict()
+        elif op == "logs" and request.get("test"):
+            for line in self.read_test_log(
+                request["test"], request.get("service_name"), request.get("stream")
+            ):
+                yield {"line": line}
+        elif op == "logs":
+            job = self.get_job(request.get("job"))
+            if request.get("follow"):
+                lines = job.output.follow()
+            else:
+                lines = list(job.output.lines)
+            for line in lines:
+                yield {"line": line}
+            yield job.to_dict()
+        else:
+            raise Exception(f"Unknown request: {op}")
+
+    def remove_stale_socket(self):
+        if not os.path.exists(self.socket_path):
+            return
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(self.socket_path)
+            except ConnectionRefusedError:
+                os.remove(self.socket_path)
+                return
+        raise Exception(f"goat is already serving on {self.socket_path}")
+
+    def serve(self):
+        TEST_ENV_PARAMS.update(os.environ.copy())
+        self.remove_stale_socket()
+        self.server = socketserver.ThreadingUnixStreamServer(
+            self.socket_path, RequestHandler
+        )
+        self.server.daemon_threads = True
+        self.server.goat = self
+        sys.stdout = self.tee
+        signal.signal(signal.SIGINT, self.shutdown)
+        signal.signal(signal.SIGTERM, self.shutdown)
+        self.refresh()
+        threading.Thread(target=self.work, name="jobs", daemon=True).start()
+        threading.Thread(target=self.watch, name="watch", daemon=True).start()
+        print(
+            f"Serving on {self.socket_path} (pid {os.getpid()}), polling {SERVICE_DIR} every {self.watch_interval}s"
+        )
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            os.remove(self.socket_path)
+            sys.stdout = self.tee.stream
+
+    def shutdown(self, signal=None, frame=None):
+        print(f"Shutting down with signal {signal}")
+        self.stopped.set()
+        if self.current:
+            self.current.cancelled = True
+            self.summary.abort()
+        self.queue.put(None)
+        # serve_forever runs on this thread and shutdown waits for it to return
+        threading.Thread(target=self.server.shutdown).start()
+
+
+def send_request(request, socket_path=DAEMON_SOCKET):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(socket_path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            raise Exception(
+                f"goat is not serving on {socket_path}, start it with serve"
+            )
+        client.sendall((json.dumps(request) + "\n").encode())
+        with client.makefile("rb") as responses:
+            for line in responses:
+                yield json.loads(line)
+
+
+def format_job(job):
+    request = job["request"]
+    selection = " ".join(
+        f"{key}={request[key]}"
+        for key in ("pattern", "mode", "service_name")
+        if request.get(key)
+    )
+    line = f"#{job['job']} {job['state']} ({selection})"
+    if job["state"] in FINISHED_STATES:
+        line += f" - {job['passed']} passed, {job['failed']} failed of {job['total']}"
+    if job["start_time"] and job["end_time"]:
+        line += f" - {format_seconds(job['end_time'] - job['start_time'])}"
+    return line
+
+
+def format_status(status):
+    lines = [
+        f"Serving as pid {status['pid']} for {format_seconds(status['uptime'])} - {status['test_files']} test files - {status['queued']} jobs queued"
+    ]
+    lines += [f"[JOB]     :: {format_job(job)}" for job in status["jobs"]]
+    return "\n".join(lines)
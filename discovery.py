@@ -0,0 +1,100 @@
+import hashlib
+import mmap
+import os
+import pickle
+from constants import (
+    DISCOVERY_INDEX_FILE,
+    GO_FILE_PATTERN,
+    SCRAPE_JOBS,
+    SERVICE_DIR,
+    TEST_FILE_SUFFIX,
+)
+
+
+def scan_test_file(path):
+    service_name = path.split("/")[-2]
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return path, hashlib.sha1().hexdigest(), []
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as content:
+            digest = hashlib.sha1(content).hexdigest()
+            tests = [
+                (service_name, match[1].split(b"(")[0].decode())
+                for match in GO_FILE_PATTERN.finditer(content)
+            ]
+    return path, digest, tests
+
+
+class DiscoveryIndex:
+    """Per-file record of the TestAcc* functions found in the provider tree.
+
+    Every entry is keyed by the test file path and keeps the file's mtime,
+    size and content hash, so a refresh only re-reads files that changed.
+    """
+
+    def __init__(self, index_file=DISCOVERY_INDEX_FILE):
+        self.index_file = index_file
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        if os.path.exists(self.index_file):
+            with open(self.index_file, "rb") as file:
+                self.entries = pickle.load(file)
+
+    def save(self):
+        with open(self.index_file, "wb") as file:
+            pickle.dump(self.entries, file)
+
+    def list_test_files(self):
+        for service in sorted(os.scandir(SERVICE_DIR), key=lambda entry: entry.name):
+            if not service.is_dir():
+                continue
+            for test_file in sorted(os.scandir(service.path), key=lambda entry: entry.name):
+                if test_file.name.endswith(TEST_FILE_SUFFIX) and test_file.is_file():
+                    yield test_file.path, test_file.stat()
+
+    def scan(self, paths, jobs):
+        if jobs > 1 and len(paths) > jobs:
+            import multiprocessing
+
+            with multiprocessing.Pool(processes=jobs) as pool:
+                chunksize = max(1, len(paths) // (jobs * 4))
+                return pool.map(scan_test_file, paths, chunksize)
+        return [scan_test_file(path) for path in paths]
+
+    def refresh(self, jobs=SCRAPE_JOBS):
+        entries = {}
+        stats = {}
+        for path, stat in self.list_test_files():
+            entry = self.entries.get(path)
+            if (
+                entry
+                and entry["mtime"] == stat.st_mtime_ns
+                and entry["size"] == stat.st_size
+            ):
+                entries[path] = entry
+                continue
+            stats[path] = stat
+
+        changed = []
+        for path, digest, tests in self.scan(list(stats), jobs):
+            entry = self.entries.get(path)
+            if not entry or entry["hash"] != digest:
+                changed.append(path)
+            entries[path] = {
+                "service": path.split("/")[-2],
+                "mtime": stats[path].st_mtime_ns,
+                "size": stats[path].st_size,
+                "hash": digest,
+                "tests": [test_name for _, test_name in tests],
+            }
+        removed = [path for path in self.entries if path not in entries]
+        self.entries = entries
+        return changed, removed
+
+    def tests(self):
+        for path in sorted(self.entries):
+            entry = self.entries[path]
+            for test_name in entry["tests"]:
+                yield entry["service"], test_name, path
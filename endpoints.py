@@ -0,0 +1,118 @@
+import collections
+import threading
+import urllib.parse
+import requests
+from colorama import Fore
+from constants import (
+    ENDPOINT_ENV_VARS,
+    ENDPOINT_S3_ENV_VAR,
+    HEALTH_CHECK_INTERVAL,
+    HEALTH_CHECK_RETRIES,
+    LOCALSTACK_S3_HOST,
+)
+from utils import get_health_latency
+
+
+class EndpointPool:
+    """Spreads running tests over several LocalStack endpoints.
+
+    Each test (or batch) leases the healthy endpoint with the fewest tests
+    running on it and gets that endpoint in its environment. A background
+    thread probes every endpoint over a keep-alive session and takes the
+    ones that stop answering out of rotation until they recover.
+    """
+
+    def __init__(self, endpoints, interval=HEALTH_CHECK_INTERVAL):
+        self.endpoints = list(endpoints)
+        self.interval = interval
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_maxsize=len(self.endpoints), max_retries=HEALTH_CHECK_RETRIES
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.latencies = {}
+        self.load = collections.Counter()
+        self.condition = threading.Condition()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    @property
+    def healthy(self):
+        return [
+            endpoint
+            for endpoint in self.endpoints
+            if self.latencies.get(endpoint) is not None
+        ]
+
+    @property
+    def latency(self):
+        latencies = [self.latencies[endpoint] for endpoint in self.healthy]
+        return max(latencies) if latencies else None
+
+    def check(self):
+        latencies = {
+            endpoint: get_health_latency(endpoint, self.session)
+            for endpoint in self.endpoints
+        }
+        with self.condition:
+            for endpoint, latency in latencies.items():
+                was_healthy = self.latencies.get(endpoint) is not None
+                if endpoint in self.latencies and was_healthy != (latency is not None):
+                    state = "up" if latency is not None else "down"
+                    color = Fore.GREEN if latency is not None else Fore.RED
+                    print(f"{color}[ENDPOINT] :: {endpoint} is {state}")
+                self.latencies[endpoint] = latency
+            self.condition.notify_all()
+        return self.healthy
+
+    def monitor(self):
+        while not self.stopped.wait(self.interval):
+            self.check()
+
+    def start(self):
+        self.check()
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.monitor, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        with self.condition:
+            self.condition.notify_all()
+        self.session.close()
+
+    def acquire(self, weight=1):
+        with self.condition:
+            while not self.healthy and not self.stopped.is_set():
+                print(f"{Fore.YELLOW}[ENDPOINT] :: waiting for a healthy endpoint")
+                self.condition.wait()
+            candidates = self.healthy or self.endpoints
+            endpoint = min(
+                candidates,
+                key=lambda endpoint: (
+                    self.load[endpoint],
+                    self.latencies.get(endpoint) or 0,
+                ),
+            )
+            self.load[endpoint] += weight
+            return endpoint
+
+    def release(self, endpoint, weight=1):
+        with self.condition:
+            self.load[endpoint] -= weight
+
+    def get_env(self, endpoint):
+        env = {name: endpoint for name in ENDPOINT_ENV_VARS}
+        env[ENDPOINT_S3_ENV_VAR] = get_s3_endpoint(endpoint)
+        return env
+
+
+def get_s3_endpoint(endpoint):
+    # buckets are addressed as virtual hosts, which only resolve for a local
+    # LocalStack through its wildcard DNS name
+    url = urllib.parse.urlsplit(endpoint)
+    if url.hostname not in ("localhost", "127.0.0.1"):
+        return endpoint
+    netloc = f"{LOCALSTACK_S3_HOST}:{url.port}" if url.port else LOCALSTACK_S3_HOST
+    return urllib.parse.urlunsplit(url._replace(netloc=netloc))
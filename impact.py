@@ -0,0 +1,169 @@
+import os
+import subprocess
+from colorama import Fore
+from constants import GO_MODULE_FILES, REPO_PATH, TEST_DIR, TEST_FILE_SUFFIX
+
+SERVICE_PREFIX = os.path.normpath(TEST_DIR) + "/"
+
+
+def run_git(*args, repo_path=REPO_PATH):
+    result = subprocess.run(
+        ["git", "-C", repo_path, *args], capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise Exception(f"git {' '.join(args)} failed: {result.stderr.strip()}")
+    return [line for line in result.stdout.splitlines() if line]
+
+
+def get_changed_files(ref, repo_path=REPO_PATH):
+    # committed and uncommitted changes since ref, plus files git does not track yet
+    changed = run_git(
+        "diff", "--name-only", "--relative", ref, "--", repo_path=repo_path
+    )
+    untracked = run_git(
+        "ls-files", "--others", "--exclude-standard", repo_path=repo_path
+    )
+    return sorted(set(changed + untracked))
+
+
+def run_go_list(*args, repo_path=REPO_PATH):
+    result = subprocess.run(
+        ["go", "list", *args], cwd=repo_path, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise Exception(f"go list {' '.join(args)} failed: {result.stderr.strip()}")
+    return [line for line in result.stdout.splitlines() if line]
+
+
+def get_package_dependents(package_dirs, repo_path=REPO_PATH):
+    """Returns {package dir: services whose tests import it, directly or
+    through other packages} of the given module-relative package dirs."""
+    module = run_go_list("-m", repo_path=repo_path)[0]
+    import_paths = {
+        f"{module}/{package_dir}": package_dir for package_dir in package_dirs
+    }
+    service_prefix = f"{module}/{SERVICE_PREFIX}"
+    dependents = {package_dir: set() for package_dir in package_dirs}
+    # -e keeps going past packages that fail to load, e.g. a broken edit
+    for line in run_go_list(
+        "-e",
+        "-test",
+        "-f",
+        '{{.ImportPath}}\t{{join .Deps " "}}',
+        f"{TEST_DIR}/...",
+        repo_path=repo_path,
+    ):
+        import_path, _, deps = line.partition("\t")
+        # test variants are listed as "<package> [<package>.test]"
+        # and the generated test main as "<package>.test"
+        import_path = import_path.split(" ")[0]
+        if not import_path.startswith(service_prefix):
+            continue
+        service = import_path[len(service_prefix) :].split("/")[0]
+        service = service.removesuffix(".test").removesuffix("_test")
+        for dep in deps.split(" "):
+            if dep in import_paths:
+                dependents[import_paths[dep]].add(service)
+    return dependents
+
+
+class ChangeImpact:
+    """Maps files changed in the provider checkout to the tests they affect.
+
+    - a `_test.go` file in a service package affects the tests defined in
+      it, or the whole package if it defines none (helpers, exports)
+    - any other Go file in a service package affects the whole package
+    - Go files of other packages (internal/acctest, internal/conns, ...)
+      affect the service packages whose tests import them, directly or
+      not; every test when the imports cannot be listed
+    - go.mod/go.sum affect every test
+    - anything else (docs, website, changelog) affects nothing
+    """
+
+    def __init__(self, ref, changed_files):
+        self.ref = ref
+        self.changed_files = changed_files
+        self.test_files = set()
+        self.services = set()
+        self.packages = {}
+        self.dependent_services = set()
+        self.global_files = []
+        self.ignored_files = []
+        for path in changed_files:
+            self.classify(path)
+
+    def classify(self, path):
+        if os.path.basename(path) in GO_MODULE_FILES:
+            self.global_files.append(path)
+        elif not path.endswith(".go"):
+            self.ignored_files.append(path)
+        elif (
+            path.startswith(SERVICE_PREFIX)
+            and path.count("/") == SERVICE_PREFIX.count("/") + 1
+        ):
+            if path.endswith(TEST_FILE_SUFFIX):
+                self.test_files.add(path)
+            else:
+                self.services.add(path.split("/")[-2])
+        else:
+            self.packages.setdefault(os.path.dirname(path), []).append(path)
+
+    def resolve(self, store):
+        # a changed test file without any test in it holds shared helpers
+        known_files = store.get_test_files(self.test_files)
+        for path in self.test_files - known_files:
+            self.services.add(path.split("/")[-2])
+        self.test_files &= known_files
+        if not self.packages:
+            return
+        try:
+            dependents = get_package_dependents(list(self.packages))
+        except Exception as e:
+            print(f"{Fore.YELLOW}Cannot map changed packages to services: {e}")
+            for paths in self.packages.values():
+                self.global_files += paths
+            self.packages = {}
+            return
+        self.packages = dependents
+        for services in dependents.values():
+            self.dependent_services |= services
+
+    def get_reason(self, test_detail):
+        if self.global_files:
+            return "global change"
+        if test_detail.service_name in self.services:
+            return "changed service package"
+        if test_detail.service_name in self.dependent_services:
+            return "changed imported package"
+        if test_detail.test_file in self.test_files:
+            return "changed test file"
+        if test_detail.completed and test_detail.return_code != 0:
+            return "previously failed"
+        return None
+
+    def print_changes(self):
+        print(
+            f"Changed since {self.ref}: {len(self.changed_files)} files ({len(self.test_files)} test files, {len(self.services)} service packages, {len(self.packages)} imported packages, {len(self.global_files)} global, {len(self.ignored_files)} ignored)"
+        )
+        for package_dir, services in sorted(self.packages.items()):
+            print(
+                f"[PACKAGE] :: {package_dir} - imported by the tests of {len(services)} services"
+            )
+        if self.global_files:
+            print(
+                f"{Fore.YELLOW}Every test is selected, these changes affect all of them:"
+            )
+        for path in self.global_files[:10]:
+            print(f"[GLOBAL]  :: {path}")
+        if len(self.global_files) > 10:
+            print(f"[GLOBAL]  :: ... and {len(self.global_files) - 10} more")
+
+
+def get_revision(ref="HEAD", repo_path=REPO_PATH):
+    # None when the provider is not a git checkout or ref does not exist
+    try:
+        return run_git(
+            "rev-parse", "--verify", "--quiet", f"{ref}^{{commit}}", repo_path=repo_path
+        )[0]
+    except Exception:
+        return None
@@ -0,0 +1,150 @@
+import collections
+import gzip
+import os
+import threading
+from constants import LOG_COMPRESSION, LOG_COMPRESS_LEVEL, LOG_MAX_MB
+
+TRUNCATED_MARKER = "\n[goat] ... {} bytes truncated ...\n\n"
+# writers not closed yet, closed on termination so no gzip log is left
+# without its trailer
+OPEN_WRITERS = set()
+
+
+def open_log(path, mode="rb"):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+class LogPolicy:
+    """How test output is written: compression, size cap and failure handling."""
+
+    def __init__(
+        self,
+        compression=LOG_COMPRESSION,
+        max_mb=LOG_MAX_MB,
+        keep_failed=False,
+        compress_level=LOG_COMPRESS_LEVEL,
+    ):
+        self.compression = compression
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.keep_failed = keep_failed
+        self.compress_level = compress_level
+
+    @property
+    def suffix(self):
+        return ".gz" if self.compression == "gzip" else ""
+
+    def open_file(self, path):
+        if self.compression == "gzip":
+            return gzip.open(path, "wb", compresslevel=self.compress_level)
+        return open(path, "wb")
+
+    def open(self, path):
+        return LogWriter(path + self.suffix, self)
+
+
+class LogWriter:
+    """Streams output into a log file, keeping only the head and tail once
+    the policy's size cap is reached.
+
+    With `keep_failed` the full output is streamed to a side file and kept
+    only if the test fails; passing tests are cut down to head and tail.
+    """
+
+    def __init__(self, path, policy):
+        self.path = path
+        self.policy = policy
+        self.head_bytes = policy.max_bytes // 2
+        self.tail_bytes = policy.max_bytes - self.head_bytes
+        self.written = 0
+        self.tail = collections.deque()
+        self.tail_size = 0
+        self.lock = threading.Lock()
+        self.closed = False
+        # drop a log left by an earlier run with a different compression
+        base_path = path[: -len(".gz")] if path.endswith(".gz") else path
+        for stale in (base_path, base_path + ".gz"):
+            if stale != path and os.path.exists(stale):
+                os.remove(stale)
+        if self.capped and policy.keep_failed:
+            self.full_path = f"{base_path}.full{policy.suffix}"
+            self.file = policy.open_file(self.full_path)
+        else:
+            self.full_path = None
+            self.file = policy.open_file(path)
+        OPEN_WRITERS.add(self)
+
+    @property
+    def capped(self):
+        return self.policy.max_bytes > 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        with self.lock:
+            if self.closed:
+                return
+            if self.full_path or not self.capped:
+                self.file.write(data)
+            elif self.written < self.head_bytes:
+                self.file.write(data[: self.head_bytes - self.written])
+            self.written += len(data)
+            if self.capped:
+                self.keep_tail(data)
+
+    def keep_tail(self, data):
+        overflow = self.written - self.head_bytes
+        if overflow <= 0:
+            return
+        data = data[-overflow:]
+        self.tail.append(data)
+        self.tail_size += len(data)
+        while self.tail and self.tail_size - len(self.tail[0]) >= self.tail_bytes:
+            self.tail_size -= len(self.tail.popleft())
+
+    def write_tail(self, file):
+        tail = b"".join(self.tail)[-self.tail_bytes :] if self.tail_bytes else b""
+        truncated = self.written - self.head_bytes - len(tail)
+        if truncated > 0:
+            file.write(TRUNCATED_MARKER.format(truncated).encode())
+        file.write(tail)
+
+    def close(self, failed=False):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            OPEN_WRITERS.discard(self)
+            if self.capped and not self.full_path:
+                self.write_tail(self.file)
+            self.file.close()
+            if not self.full_path:
+                return
+            if failed or self.written <= self.policy.max_bytes:
+                os.replace(self.full_path, self.path)
+                return
+            with open_log(self.full_path) as full:
+                head = full.read(self.head_bytes)
+            with self.policy.open_file(self.path) as capped:
+                capped.write(head)
+                self.write_tail(capped)
+            os.remove(self.full_path)
+
+
+def close_open_logs():
+    # the tests were killed, so their full logs are kept
+    for writer in list(OPEN_WRITERS):
+        writer.close(failed=True)
+
+
+def pump(pipe, writer):
+    for chunk in iter(lambda: pipe.read1(65536), b""):
+        writer.write(chunk)
+    pipe.close()
+
+
+def start_pump(pipe, writer):
+    thread = threading.Thread(target=pump, args=(pipe, writer), daemon=True)
+    thread.start()
+    return thread
@@ -1,10 +1,65 @@
-from email.policy import default
+import json
 import os
-from pydoc import cli
-from constants import TEST_ENV_PARAMS, SERVICES_TO_TEST, TEST_LIST_FILE
-from models import TestSummary
-from utils import check_health_status, run_report_server
+import sys
+from constants import (
+    ADAPTIVE_MAX_PROCESSES,
+    ADAPTIVE_MIN_PROCESSES,
+    BATCH_PARALLEL,
+    BINARY_CACHE_BUDGET_MB,
+    BREAKER_CONSECUTIVE_FAILURES,
+    BREAKER_FAILURE_RATE,
+    DAEMON_SOCKET,
+    HEALTH_WAIT_TIMEOUT,
+    LOG_COMPRESSION,
+    LOG_MAX_MB,
+    POOL_PROCESSES,
+    QUARANTINE_PROCESSES,
+    RETRY_BUDGET,
+    ROOT_DIR,
+    SEARCH_MODES,
+    SCRAPE_JOBS,
+    SERVICES_TO_TEST,
+    TEST_ENV_PARAMS,
+    TEST_LIST_FILE,
+    TIMEOUT_MULTIPLIER,
+    TRACE_FILE,
+    TREND_ALPHA,
+    TREND_MIN_RATIO,
+    TREND_WINDOW,
+    WARMUP_JOBS,
+    WATCH_INTERVAL,
+)
+from binary_cache import TestBinaryCache
+from log_writer import LogPolicy
+from models import RunOptions, TestSummary
+from scheduler import CircuitBreaker, ConcurrencyController, Scheduler
+from store import ResultStore
+from warmup import Warmup
+from utils import (
+    check_health_status,
+    parse_endpoints,
+    parse_service_caps,
+    parse_shard,
+    wait_for_health,
+)
 import click
+from colorama import Fore
+
+
+def parse_shard_option(value):
+    if value is None:
+        return None
+    try:
+        return parse_shard(value)
+    except ValueError as e:
+        raise click.BadParameter(f"expected i/N with 1 <= i <= N ({e})")
+
+
+def parse_service_caps_option(value):
+    try:
+        return parse_service_caps(value)
+    except ValueError as e:
+        raise click.BadParameter(f"expected N or service=N with N >= 1 ({e})")
 
 
 @click.group(name="autest", help="Automated tests for localstack")
@@ -13,13 +68,19 @@ def cli():
 
 
 @click.command(name="scrape", help="Scrape metadata from test files")
-def generate():
+@click.option(
+    "--jobs",
+    "-j",
+    default=SCRAPE_JOBS,
+    type=int,
+    help="Number of processes used to scan test files",
+)
+def generate(jobs):
     """Scrape metadata from test files"""
     TEST_ENV_PARAMS.update(os.environ.copy())
     test_manager = TestSummary()
-    test_manager.scrape_tests()
+    test_manager.scrape_tests(jobs=jobs)
     test_manager.export_test_details()
-    test_manager.save()
 
 
 @click.command(name="report", help="Generate report from test details")
@@ -33,14 +94,18 @@ def generate():
 def report(server):
     """Generate report from test details"""
     TEST_ENV_PARAMS.update(os.environ.copy())
-    test_manager = TestSummary()
+    test_manager = TestSummary(scrape=False)
     test_manager.generate_report()
     if server:
+        from report_server import run_report_server
+
         run_report_server()
 
 
 @click.command(name="run", help="Run tests for given services")
-@click.option("--services", "-s", default=SERVICES_TO_TEST, help="Services to test")
+@click.option(
+    "--services", "-s", default=",".join(SERVICES_TO_TEST), help="Services to test"
+)
 @click.option(
     "--force-run", "-f", is_flag=True, default=False, help="Run tests forcefully"
 )
@@ -55,22 +120,343 @@ def report(server):
     "-p",
     help="Pattern to match test names against",
 )
-def run(services, force_run, test_list_file, pattern):
+@click.option(
+    "--batch-size",
+    "-b",
+    default=0,
+    type=int,
+    help="Run up to this many tests per `go test -json` process (0 disables batching)",
+)
+@click.option(
+    "--parallel",
+    default=BATCH_PARALLEL,
+    type=click.IntRange(min=1),
+    help="Value passed to `go test -parallel` for batched runs",
+)
+@click.option(
+    "--binary-cache",
+    is_flag=True,
+    default=False,
+    help="Build each service's test binary once and run tests from the cache",
+)
+@click.option(
+    "--binary-cache-budget",
+    default=BINARY_CACHE_BUDGET_MB,
+    type=int,
+    help="Disk budget of the test binary cache in MB",
+)
+@click.option(
+    "--adaptive",
+    is_flag=True,
+    default=False,
+    help="Adapt the number of concurrent tests to system load and LocalStack latency",
+)
+@click.option(
+    "--min-jobs",
+    default=ADAPTIVE_MIN_PROCESSES,
+    type=click.IntRange(min=1),
+    help="Lower bound of concurrent tests in adaptive mode",
+)
+@click.option(
+    "--max-jobs",
+    default=ADAPTIVE_MAX_PROCESSES,
+    type=click.IntRange(min=1),
+    help="Upper bound of concurrent tests in adaptive mode",
+)
+@click.option(
+    "--fair",
+    is_flag=True,
+    default=False,
+    help="Interleave services by serving the one with the fewest running tests first",
+)
+@click.option(
+    "--service-cap",
+    default="",
+    callback=lambda ctx, param, value: parse_service_caps_option(value),
+    help="Max concurrent tests per service: `4` for every service or `ec2=4,s3=2`",
+)
+@click.option(
+    "--log-compression",
+    type=click.Choice(["gzip", "none"]),
+    default=LOG_COMPRESSION,
+    help="Compression applied to test logs",
+)
+@click.option(
+    "--log-max-mb",
+    default=LOG_MAX_MB,
+    type=float,
+    help="Per-log size cap in MB keeping head and tail (0 keeps everything)",
+)
+@click.option(
+    "--keep-failed-logs",
+    is_flag=True,
+    default=False,
+    help="Keep full logs for failed tests and only cap logs of passed tests (needs --log-max-mb)",
+)
+@click.option(
+    "--shard",
+    callback=lambda ctx, param, value: parse_shard_option(value),
+    help="Run only shard i of N (`i/N`), balanced by recorded test durations",
+)
+@click.option(
+    "--endpoints",
+    "-e",
+    help="Comma separated LocalStack endpoints to spread tests over",
+)
+@click.option(
+    "--rerun-failed",
+    is_flag=True,
+    default=False,
+    help="Run only the tests that failed in earlier runs",
+)
+@click.option(
+    "--retries",
+    default=RETRY_BUDGET,
+    type=click.IntRange(min=0),
+    help="Retry failed tests up to this many times; a test passing on retry is flaky",
+)
+@click.option(
+    "--quarantine-jobs",
+    default=QUARANTINE_PROCESSES,
+    type=click.IntRange(min=1),
+    help="Max concurrent quarantined (repeatedly flaky) tests, which run last",
+)
+@click.option(
+    "--changed-since",
+    help="Run only tests affected by provider changes since this git ref, plus earlier failures",
+)
+@click.option(
+    "--timeout-multiplier",
+    default=TIMEOUT_MULTIPLIER,
+    type=float,
+    help="Kill a test after this multiple of its usual duration (0 disables)",
+)
+@click.option(
+    "--circuit-breaker",
+    is_flag=True,
+    default=False,
+    help="Stop running a service's tests once too many of them fail",
+)
+@click.option(
+    "--breaker-failures",
+    default=BREAKER_CONSECUTIVE_FAILURES,
+    type=int,
+    help="Consecutive failures tripping the circuit breaker (0 disables)",
+)
+@click.option(
+    "--breaker-rate",
+    default=BREAKER_FAILURE_RATE,
+    type=float,
+    help="Failure rate tripping the circuit breaker (0 disables)",
+)
+@click.option(
+    "--warmup-jobs",
+    default=WARMUP_JOBS,
+    type=int,
+    help="Test packages compiled in parallel before tests start (0 disables)",
+)
+@click.option(
+    "--health-wait",
+    default=HEALTH_WAIT_TIMEOUT,
+    type=int,
+    help="Seconds to wait for LocalStack to come up",
+)
+def run(
+    services,
+    force_run,
+    test_list_file,
+    pattern,
+    batch_size,
+    parallel,
+    binary_cache,
+    binary_cache_budget,
+    adaptive,
+    min_jobs,
+    max_jobs,
+    fair,
+    service_cap,
+    log_compression,
+    log_max_mb,
+    keep_failed_logs,
+    shard,
+    endpoints,
+    rerun_failed,
+    retries,
+    quarantine_jobs,
+    changed_since,
+    timeout_multiplier,
+    circuit_breaker,
+    breaker_failures,
+    breaker_rate,
+    warmup_jobs,
+    health_wait,
+):
     """Run tests for given services"""
+    if changed_since:
+        from impact import get_revision
+
+        if not get_revision(changed_since):
+            raise click.BadParameter(
+                f"{changed_since} is not a commit of the provider checkout",
+                param_hint="--changed-since",
+            )
+    if adaptive and max_jobs < min_jobs:
+        raise click.BadParameter(
+            f"must be at least --min-jobs ({min_jobs})", param_hint="--max-jobs"
+        )
+    if keep_failed_logs and log_max_mb <= 0:
+        raise click.BadParameter(
+            "only applies to capped logs, set --log-max-mb above 0",
+            param_hint="--keep-failed-logs",
+        )
     print(f"Services to test: {services}")
     TEST_ENV_PARAMS.update(os.environ.copy())
-    if not check_health_status():
+    services = [service for service in services.split(",") if len(service) > 0]
+    if binary_cache:
+        binary_cache = TestBinaryCache(budget_mb=binary_cache_budget)
+    else:
+        binary_cache = None
+    warmup = None
+    if warmup_jobs > 0:
+        # compiles while LocalStack is polled
+        warmup = Warmup(services, warmup_jobs, binary_cache)
+        warmup.start()
+    endpoint_pool = None
+    if endpoints:
+        from endpoints import EndpointPool
+
+        endpoint_pool = EndpointPool(parse_endpoints(endpoints))
+        wait_for_health(endpoint_pool.check, health_wait)
+        endpoint_pool.start()
+        healthy = endpoint_pool.healthy
+        print(f"Healthy endpoints: {len(healthy)}/{len(endpoint_pool.endpoints)}")
+    else:
+        healthy = wait_for_health(check_health_status, health_wait)
+    if not healthy:
         print(
             "Localstack is not running. Please start localstack before running tests."
         )
         os._exit(1)
-    test_manager = TestSummary(test_list_file=test_list_file)
+    scheduler = None
+    if adaptive:
+        scheduler = Scheduler(
+            controller=ConcurrencyController(
+                min_jobs, max_jobs, endpoint_pool=endpoint_pool
+            )
+        )
+    test_manager = TestSummary(test_list_file=test_list_file, scheduler=scheduler)
+    test_manager.handle_signals()
     print("Running tests...")
+    options = RunOptions(
+        batch_size=batch_size,
+        parallel=parallel,
+        binary_cache=binary_cache,
+        service_caps=service_cap,
+        fair=fair,
+        log_policy=LogPolicy(log_compression, log_max_mb, keep_failed_logs),
+        endpoint_pool=endpoint_pool,
+        retries=retries,
+        quarantine_jobs=quarantine_jobs,
+        timeout_multiplier=timeout_multiplier,
+        breaker=(
+            CircuitBreaker(breaker_failures, breaker_rate) if circuit_breaker else None
+        ),
+        warmup=warmup,
+    )
+    test_manager.execute_tests(
+        services=services,
+        pattern=pattern,
+        force_run=force_run,
+        shard=shard,
+        rerun_failed=rerun_failed,
+        changed_since=changed_since,
+        options=options,
+    )
+    if endpoint_pool:
+        endpoint_pool.stop()
+
+
+@click.command(name="shard-matrix", help="Print the shard matrix as JSON")
+@click.option(
+    "--services", "-s", default=",".join(SERVICES_TO_TEST), help="Services to test"
+)
+@click.option("--shards", "-n", default=1, type=int, help="Number of shards")
+@click.option(
+    "--pattern",
+    "-p",
+    help="Pattern to match test names against",
+)
+def shard_matrix(services, shards, pattern):
+    """Print the shard matrix as JSON"""
+    test_manager = TestSummary()
     services = [service for service in services.split(",") if len(service) > 0]
-    for service in services:
-        test_manager.execute_tests(
-            service=service, pattern=pattern, force_run=force_run
-        )
+    print(json.dumps(test_manager.get_shard_matrix(services, shards, pattern)))
+
+
+@click.command(name="merge", help="Merge the results of several runs into one store")
+@click.argument("inputs", nargs=-1, required=True)
+@click.option(
+    "--output-dir",
+    "-o",
+    default=ROOT_DIR,
+    help="Directory of the merged results.db and logs",
+)
+def merge(inputs, output_dir):
+    """Merge the results of several runs into one store"""
+    from merge import merge_results
+
+    os.makedirs(output_dir, exist_ok=True)
+    merge_results(inputs, output_dir)
+
+
+@click.command(name="trace", help="Export a run as a Chrome trace timeline")
+@click.option("--run-id", "-r", type=int, help="Run to export (defaults to the last)")
+@click.option("--output-file", "-o", default=TRACE_FILE, help="Name of output file")
+def trace(run_id, output_file):
+    """Export a run as a Chrome trace timeline"""
+    from timeline import export_trace
+
+    export_trace(ResultStore(), run_id, output_file)
+
+
+@click.command(name="trends", help="Show duration trends and flag slowdowns")
+@click.option("--base", "-b", help="Run id or provider ref to compare against")
+@click.option(
+    "--head", help="Run id or provider ref to compare (defaults to the last run)"
+)
+@click.option("--service-name", "-s", help="Only show tests of this service")
+@click.option(
+    "--window",
+    "-w",
+    default=TREND_WINDOW,
+    type=int,
+    help="Runs compared against without --base, and covered by medians",
+)
+@click.option(
+    "--alpha", default=TREND_ALPHA, type=float, help="Significance level of slowdowns"
+)
+@click.option(
+    "--min-ratio",
+    default=TREND_MIN_RATIO,
+    type=float,
+    help="Smallest slowdown flagged, as a ratio of median durations",
+)
+@click.option("--all", "-a", is_flag=True, default=False, help="Show every test")
+@click.option(
+    "--fail-on-regression",
+    is_flag=True,
+    default=False,
+    help="Exit with 1 when a slowdown is found",
+)
+def trends(base, head, service_name, window, alpha, min_ratio, all, fail_on_regression):
+    """Show duration trends and flag slowdowns"""
+    from trends import show_trends
+
+    slower = show_trends(
+        ResultStore(), base, head, service_name, window, alpha, min_ratio, all
+    )
+    if slower and fail_on_regression:
+        sys.exit(1)
 
 
 @click.command(name="details", help="Get test details")
@@ -79,18 +465,16 @@ def run(services, force_run, test_list_file, pattern):
 @click.option("--test-name", "-n", help="Test name")
 def get_details(service_name, test_file, test_name):
     """Get test details"""
-    test_manager = TestSummary()
+    test_manager = TestSummary(scrape=False)
     test_manager.get_test_details(service_name, test_file, test_name)
-    test_manager.save()
 
 
 @click.command(name="list-services", help="Get list of service")
 @click.option("--all", "-a", is_flag=True, default=False, help="Returns all services")
 def list_services(all):
     """Get list of service"""
-    test_manager = TestSummary()
+    test_manager = TestSummary(scrape=False)
     services = test_manager.get_services_list(all)
-    test_manager.save()
     print(services)
 
 
@@ -98,7 +482,7 @@ def list_services(all):
 @click.option("--service-name", "-s", help="Service name for test")
 def print_summary(service_name):
     """Gets the summary of the tests"""
-    test_manager = TestSummary()
+    test_manager = TestSummary(scrape=False)
     test_manager.print_summary(service_name)
 
 
@@ -106,32 +490,229 @@ def print_summary(service_name):
 @click.option("--output-file", "-o", help="Name of output file")
 def get_yaml(output_file):
     """Gets the yaml of the tests"""
-    test_manager = TestSummary()
+    test_manager = TestSummary(scrape=False)
     test_manager.get_yaml(output_file)
 
 
 @click.command(name="list", help="List down the test cases")
 @click.option("--pattern", "-p", help="patterns in the test you want to search for")
-def list_tests(pattern):
+@click.option(
+    "--mode",
+    "-m",
+    type=click.Choice(SEARCH_MODES),
+    default="substring",
+    help="How the pattern is matched against test names",
+)
+@click.option("--service-name", "-s", help="Only search tests of this service")
+def list_tests(pattern, mode, service_name):
     """List down the test cases"""
-    test_manager = TestSummary()
-    test_manager.list_tests(pattern)
+    test_manager = TestSummary(scrape=False)
+    try:
+        test_manager.list_tests(pattern, mode, service_name)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--pattern")
+
 
 @click.command(name="local", help="runs tests for local execution")
 @click.option("--pattern", "-p", help="patterns in the test you want to run")
-def local(pattern):
+@click.option(
+    "--mode",
+    "-m",
+    type=click.Choice(SEARCH_MODES),
+    default="substring",
+    help="How the pattern is matched against test names",
+)
+@click.option("--service-name", "-s", help="Only run tests of this service")
+@click.option(
+    "--jobs",
+    "-j",
+    default=POOL_PROCESSES,
+    type=click.IntRange(min=1),
+    help="Number of parallel tests",
+)
+def local(pattern, mode, service_name, jobs):
     """runs tests for local execution"""
-    test_manager = TestSummary()
-    test_manager.local(pattern)
+    if not pattern and not service_name:
+        raise click.BadParameter(
+            "pass --pattern or --service-name, or use run for every test",
+            param_hint="--pattern",
+        )
+    test_manager = TestSummary(scheduler=Scheduler(processes=jobs))
+    test_manager.handle_signals()
+    try:
+        test_manager.local(pattern, mode, service_name)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint="--pattern")
+
+
+@click.command(name="serve", help="Serve runs over a local control socket")
+@click.option("--socket", "socket_path", default=DAEMON_SOCKET, help="Socket path")
+@click.option(
+    "--jobs",
+    "-j",
+    default=POOL_PROCESSES,
+    type=click.IntRange(min=1),
+    help="Number of parallel tests",
+)
+@click.option(
+    "--binary-cache",
+    is_flag=True,
+    default=False,
+    help="Run tests from cached per-service test binaries",
+)
+@click.option(
+    "--binary-cache-budget",
+    default=BINARY_CACHE_BUDGET_MB,
+    type=int,
+    help="Disk budget of the test binary cache in MB",
+)
+@click.option(
+    "--warmup-jobs",
+    default=WARMUP_JOBS,
+    type=int,
+    help="Test packages compiled in parallel after they change (0 disables)",
+)
+@click.option(
+    "--watch-interval",
+    default=WATCH_INTERVAL,
+    type=float,
+    help="Seconds between polls of the provider tree",
+)
+def serve(
+    socket_path, jobs, binary_cache, binary_cache_budget, warmup_jobs, watch_interval
+):
+    """Serve runs over a local control socket"""
+    from daemon import GoatDaemon
+
+    if binary_cache:
+        binary_cache = TestBinaryCache(budget_mb=binary_cache_budget)
+    else:
+        binary_cache = None
+    GoatDaemon(
+        socket_path,
+        jobs,
+        binary_cache,
+        warmup_jobs=warmup_jobs,
+        watch_interval=watch_interval,
+    ).serve()
+
+
+@click.group(name="client", help="Send requests to a running serve")
+@click.option("--socket", "socket_path", default=DAEMON_SOCKET, help="Socket path")
+@click.pass_context
+def client(ctx, socket_path):
+    ctx.obj = socket_path
+
+
+def send_client_request(socket_path, request):
+    from daemon import format_job, format_status, send_request
+
+    job = None
+    try:
+        for message in send_request(request, socket_path):
+            if "error" in message:
+                raise Exception(message["error"])
+            if "line" in message:
+                print(message["line"])
+            elif "job" in message:
+                job = message
+                print(f"[JOB]     :: {format_job(job)}")
+            else:
+                print(format_status(message))
+    except Exception as e:
+        print(f"{Fore.RED}{e}")
+        sys.exit(1)
+    return job
+
+
+@client.command(name="run", help="Queue a run of the matching tests")
+@click.option("--pattern", "-p", help="patterns in the test you want to run")
+@click.option(
+    "--mode",
+    "-m",
+    type=click.Choice(SEARCH_MODES),
+    default="substring",
+    help="How the pattern is matched against test names",
+)
+@click.option("--service-name", "-s", help="Only run tests of this service")
+@click.option(
+    "--detach",
+    "-d",
+    is_flag=True,
+    default=False,
+    help="Return once queued instead of following the output",
+)
+@click.pass_obj
+def client_run(socket_path, pattern, mode, service_name, detach):
+    """Queue a run of the matching tests"""
+    job = send_client_request(
+        socket_path,
+        {
+            "op": "run",
+            "pattern": pattern,
+            "mode": mode,
+            "service_name": service_name,
+            "follow": not detach,
+        },
+    )
+    if not detach and (not job or job["state"] != "passed"):
+        sys.exit(1)
+
+
+@client.command(name="cancel", help="Cancel a queued or running job")
+@click.argument("job", required=False, type=int)
+@click.pass_obj
+def client_cancel(socket_path, job):
+    """Cancel a queued or running job"""
+    send_client_request(socket_path, {"op": "cancel", "job": job})
+
+
+@client.command(name="status", help="Show the daemon and its jobs")
+@click.pass_obj
+def client_status(socket_path):
+    """Show the daemon and its jobs"""
+    send_client_request(socket_path, {"op": "status"})
+
+
+@client.command(name="logs", help="Print the output of a job or the log of a test")
+@click.argument("job", required=False, type=int)
+@click.option(
+    "--follow", "-f", is_flag=True, default=False, help="Follow a running job"
+)
+@click.option("--test-name", "-n", help="Print this test's log instead")
+@click.option("--service-name", "-s", help="Service of the test")
+@click.option(
+    "--stderr", is_flag=True, default=False, help="Print the test's stderr log"
+)
+@click.pass_obj
+def client_logs(socket_path, job, follow, test_name, service_name, stderr):
+    """Print the output of a job or the log of a test"""
+    send_client_request(
+        socket_path,
+        {
+            "op": "logs",
+            "job": job,
+            "follow": follow,
+            "test": test_name,
+            "service_name": service_name,
+            "stream": "stderr" if stderr else "stdout",
+        },
+    )
 
 
 cli.add_command(generate)
 cli.add_command(report)
 cli.add_command(run)
+cli.add_command(shard_matrix)
+cli.add_command(merge)
+cli.add_command(trace)
+cli.add_command(trends)
 cli.add_command(get_details)
 cli.add_command(list_services)
 cli.add_command(print_summary)
 cli.add_command(get_yaml)
 cli.add_command(list_tests)
 cli.add_command(local)
+cli.add_command(serve)
+cli.add_command(client)
 cli()
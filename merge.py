@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+from colorama import Fore
+from constants import LOG_PATH, PICKLE_TEST_DETAILS_FILE, RESULT_STORE_FILE, ROOT_DIR
+from store import ResultStore
+
+RESULT_STORE_NAME = os.path.basename(RESULT_STORE_FILE)
+PICKLE_NAME = os.path.basename(PICKLE_TEST_DETAILS_FILE)
+LOG_DIR_NAME = os.path.basename(LOG_PATH)
+LOG_SUFFIXES = ("", ".gz")
+
+
+def resolve_input(path):
+    """Returns the (store or pickle file, logs directory) of a merge input,
+    which is either an artifact directory or a store/pickle file in one.
+    """
+    if os.path.isdir(path):
+        for name in (RESULT_STORE_NAME, PICKLE_NAME):
+            if os.path.isfile(os.path.join(path, name)):
+                return os.path.join(path, name), os.path.join(path, LOG_DIR_NAME)
+        raise FileNotFoundError(f"No {RESULT_STORE_NAME} or {PICKLE_NAME} in {path}")
+    if not os.path.isfile(path):
+        raise FileNotFoundError(path)
+    return path, os.path.join(os.path.dirname(path), LOG_DIR_NAME)
+
+
+def copy_logs(service_name, test_name, source_dir, output_dir):
+    for stream in ("stdout", "stderr"):
+        base_name = os.path.join(service_name, f"{test_name}_{stream}.log")
+        for suffix in LOG_SUFFIXES:
+            source = os.path.join(source_dir, base_name + suffix)
+            if not os.path.isfile(source):
+                continue
+            target = os.path.join(output_dir, base_name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            # the winning log replaces the previous one whatever its compression
+            for stale in LOG_SUFFIXES:
+                if stale != suffix and os.path.exists(target + stale):
+                    os.remove(target + stale)
+            shutil.copyfile(source, target + suffix)
+            break
+
+
+def merge_results(inputs, output_dir=ROOT_DIR):
+    """Merges result stores of several runs into the one in `output_dir`.
+
+    Each input is attached to the output store in turn, so only one input is
+    open at a time and rows are moved by SQLite without passing through
+    Python. Results completed last win, and their logs are copied along.
+    """
+    output_store_path = os.path.join(output_dir, RESULT_STORE_NAME)
+    output_logs = os.path.join(output_dir, LOG_DIR_NAME)
+    store = ResultStore(output_store_path, os.path.join(output_dir, PICKLE_NAME))
+    try:
+        for path in inputs:
+            source, source_logs = resolve_input(path)
+            if os.path.abspath(source) == os.path.abspath(output_store_path):
+                print(f"{Fore.YELLOW}Skipping {path}: it is the output store")
+                continue
+            with tempfile.TemporaryDirectory() as temp_dir:
+                if not source.endswith(".db"):
+                    # old artifacts only carry a pickle, which needs a store first
+                    temp_store = ResultStore(
+                        os.path.join(temp_dir, RESULT_STORE_NAME), source
+                    )
+                    temp_store.close()
+                    source = temp_store.path
+                copied = 0
+                for service_name, test_name in store.merge_from(source):
+                    if os.path.abspath(source_logs) != os.path.abspath(output_logs):
+                        copy_logs(service_name, test_name, source_logs, output_logs)
+                    copied += 1
+            print(f"{Fore.GREEN}Merged {path}: {copied} results taken")
+    finally:
+        store.close()
+    print(f"Merged {len(inputs)} inputs into {output_store_path}")
@@ -1,86 +1,302 @@
-import glob
-import multiprocessing
-import pickle
+import collections
+import functools
+import json
 import re
 import os
+import shutil
 import signal
+import statistics
 import sys
 import time
 import subprocess
+import tempfile
+import threading
 from colorama import Fore
 from constants import (
+    BATCH_PARALLEL,
+    DEFAULT_TEST_DURATION,
+    DURATION_HISTORY_SIZE,
+    GO_TEST_PREFIX,
     REPO_PATH,
+    SCRAPE_JOBS,
+    SPARKLINE_SIZE,
     SERVICES_TO_TEST,
-    TEST_DIR_REGEX,
-    PICKLE_TEST_DETAILS_FILE,
-    GO_PATTERN,
     TEST_LIST_FILE,
     LOG_PATH,
     TEST_ENV_PARAMS,
+    TEST_REPORT_DATA_FILENAME,
     TEST_REPORT_FILENAME,
+    TEST_REPORT_SCRIPT_FILENAME,
+    TEST_REPORT_TEMPLATE,
+    POOL_PROCESSES,
     PROCESS_POOL,
+    QUARANTINE_GROUP,
+    QUARANTINE_PROCESSES,
+    RETRY_BUDGET,
+    TIMEOUT_CEILING,
+    TIMEOUT_FLOOR,
+    TIMEOUT_MULTIPLIER,
+    TIMEOUT_PERCENTILE,
 )
+from discovery import DiscoveryIndex
+from impact import ChangeImpact, get_changed_files, get_revision
+from log_writer import LogPolicy, close_open_logs, start_pump
+from scheduler import Scheduler, format_duration, shard_tests
+from store import ResultStore
+from utils import get_batch_binary_run_command
+from utils import get_batch_run_command
+from utils import get_binary_run_command
 from utils import get_test_run_command
 from utils import get_test_id
-import multiprocessing.dummy
+from utils import format_seconds
+from utils import wait_process
+from utils import get_percentile
+from utils import kill_process_tree
+from utils import start_kill_timer
+
+TIMEOUT_MARKER = (
+    "\n[goat] killed after {:.0f}s, the timeout derived from its duration history\n"
+)
+
+
+def format_usage(cpu_user, cpu_system, max_rss_kb):
+    return f" - CPU Time: {cpu_user:.3f}s user, {cpu_system:.3f}s sys - Max RSS: {max_rss_kb / 1024:.1f}MB"
+
+
+class RunOptions:
+    """How selected tests are run: batching, binary cache, concurrency caps,
+    logs, endpoints, retries, quarantine, timeouts, circuit breaker and
+    warm-up. Passed as a whole from the run down to every test and batch."""
+
+    def __init__(
+        self,
+        batch_size=0,
+        parallel=BATCH_PARALLEL,
+        binary_cache=None,
+        service_caps=None,
+        fair=False,
+        log_policy=None,
+        endpoint_pool=None,
+        retries=RETRY_BUDGET,
+        quarantine_jobs=QUARANTINE_PROCESSES,
+        timeout_multiplier=TIMEOUT_MULTIPLIER,
+        breaker=None,
+        warmup=None,
+    ):
+        self.batch_size = batch_size
+        self.parallel = parallel
+        self.binary_cache = binary_cache
+        self.service_caps = service_caps or {}
+        self.fair = fair
+        self.log_policy = log_policy or LogPolicy()
+        self.endpoint_pool = endpoint_pool
+        self.retries = retries
+        self.quarantine_jobs = quarantine_jobs
+        self.timeout_multiplier = timeout_multiplier
+        self.breaker = breaker
+        self.warmup = warmup
 
 
 class TestDetail:
+    # a summary holds one of these per test, so they carry no __dict__;
+    # pickles are tagged with SCHEMA_VERSION to tell them from legacy ones
+    SCHEMA_VERSION = 1
+    __slots__ = (
+        "service_name",
+        "test_name",
+        "return_code",
+        "start_time",
+        "end_time",
+        "process_start_time",
+        "process_end_time",
+        "monotonic_start",
+        "completed",
+        "durations",
+        "cpu_user",
+        "cpu_system",
+        "max_rss_kb",
+        "compile_time",
+        "worker",
+        "attempt",
+        "test_file",
+        "aborted",
+    )
+
     def __init__(self, service_name, test_name):
         self.service_name = service_name
         self.test_name = test_name
         self.return_code = None
-        self.start_time: time
-        self.end_time: time
-        self.process_start_time: time
-        self.process_end_time: time
+        self.start_time = None
+        self.end_time = None
+        self.process_start_time = None
+        self.process_end_time = None
+        self.monotonic_start = None
         self.completed = False
+        self.durations = []
+        self.cpu_user = None
+        self.cpu_system = None
+        self.max_rss_kb = None
+        self.compile_time = None
+        self.worker = None
+        self.attempt = 1
+        self.test_file = None
+        # killed by abort(), its result is not recorded so it stays pending
+        self.aborted = False
+
+    def __getstate__(self):
+        return self.SCHEMA_VERSION, {
+            name: getattr(self, name) for name in self.__slots__
+        }
+
+    def __setstate__(self, state):
+        # legacy pickles hold the plain __dict__ of a test, without a version
+        if isinstance(state, tuple):
+            _, state = state
+        self.__init__(state["service_name"], state["test_name"])
+        for name, value in state.items():
+            if name in self.__slots__:
+                setattr(self, name, value)
+
+    @classmethod
+    def from_row(cls, row):
+        test_detail = cls(row["service_name"], row["test_name"])
+        test_detail.return_code = row["return_code"]
+        test_detail.start_time = row["start_time"]
+        test_detail.end_time = row["end_time"]
+        test_detail.process_start_time = row["process_start_time"]
+        test_detail.process_end_time = row["process_end_time"]
+        test_detail.completed = bool(row["completed"])
+        test_detail.cpu_user = row["cpu_user"]
+        test_detail.cpu_system = row["cpu_system"]
+        test_detail.max_rss_kb = row["max_rss_kb"]
+        test_detail.compile_time = row["compile_time"]
+        test_detail.test_file = row["test_file"]
+        return test_detail
+
+    @property
+    def test_id(self):
+        return get_test_id(self.service_name, self.test_name)
 
     @property
     def elapsed_time(self):
-        diff = self.end_time - self.start_time
-        return time.strftime("%Mm %Ss", time.gmtime(diff))
+        return format_seconds(self.end_time - self.start_time)
+
+    @property
+    def usage(self):
+        if self.cpu_user is None:
+            return ""
+        return format_usage(self.cpu_user, self.cpu_system, self.max_rss_kb)
 
     @property
-    def process_elapsed_time(self):
-        diff = self.process_end_time - self.process_start_time
-        return time.strftime("%M.%S", time.gmtime(diff))
+    def estimated_duration(self):
+        if self.durations:
+            return statistics.median(self.durations)
+        if self.completed and self.return_code == 0:
+            return self.end_time - self.start_time
+        return DEFAULT_TEST_DURATION
+
+    def get_timeout(self, multiplier=TIMEOUT_MULTIPLIER):
+        if not self.durations or not multiplier:
+            return None
+        timeout = get_percentile(self.durations, TIMEOUT_PERCENTILE) * multiplier
+        return min(max(timeout, TIMEOUT_FLOOR), TIMEOUT_CEILING)
 
     @property
     def logfile_path(self):
         return f"{LOG_PATH}/{self.service_name}"
 
+    @property
+    def stdout_log(self):
+        return f"{self.logfile_path}/{self.test_name}_stdout.log"
+
+    @property
+    def stderr_log(self):
+        return f"{self.logfile_path}/{self.test_name}_stderr.log"
+
     def create_dir(self):
         os.makedirs(self.logfile_path, exist_ok=True)
 
     def pre_tests(self):
         self.start_time = time.time()
-        self.process_start_time = time.process_time()
+        self.monotonic_start = time.perf_counter()
+        self.worker = threading.current_thread().name
+        self.cpu_user = self.cpu_system = self.max_rss_kb = None
+        self.compile_time = self.process_end_time = None
         self.create_dir()
 
     def post_tests(self):
-        self.process_end_time = time.process_time()
-        self.end_time = time.time()
+        # derived from the monotonic clock, so wall clock jumps cannot skew it
+        self.end_time = self.start_time + time.perf_counter() - self.monotonic_start
         self.completed = True
+        if self.return_code == 0:
+            self.durations.append(self.end_time - self.start_time)
+            self.durations = self.durations[-DURATION_HISTORY_SIZE:]
 
-    def run(self):
+    def run(self, options):
         command = get_test_run_command(self.service_name, self.test_name)
-        stdout = open(f"{self.logfile_path}/{self.test_name}_stdout.log", "w")
-        stderr = open(f"{self.logfile_path}/{self.test_name}_stderr.log", "w")
+        cwd = REPO_PATH
+        binary_cache = options.binary_cache
+        binary = binary_cache.get(self.service_name) if binary_cache else None
+        if binary:
+            command = get_binary_run_command(binary, self.test_name)
+            cwd = binary_cache.package_path(self.service_name)
+        stdout = options.log_policy.open(self.stdout_log)
+        stderr = options.log_policy.open(self.stderr_log)
         TEST_ENV_PARAMS.update(os.environ.copy())
+        env = dict(TEST_ENV_PARAMS)
+        endpoint_pool = options.endpoint_pool
+        endpoint = endpoint_pool.acquire() if endpoint_pool else None
+        if endpoint:
+            env.update(endpoint_pool.get_env(endpoint))
+        timeout = self.get_timeout(options.timeout_multiplier)
+        try:
+            self.run_process(command, env, cwd, stdout, stderr, timeout)
+        finally:
+            if endpoint:
+                endpoint_pool.release(endpoint)
+
+    def set_usage(self, rusage, process_end_time):
+        self.process_end_time = process_end_time
+        if rusage:
+            self.cpu_user = rusage.ru_utime
+            self.cpu_system = rusage.ru_stime
+            self.max_rss_kb = rusage.ru_maxrss
+
+    def run_process(self, command, env, cwd, stdout, stderr, timeout=None):
+        self.process_start_time = time.time()
+        monotonic_start = time.perf_counter()
         process = subprocess.Popen(
             command,
-            env=TEST_ENV_PARAMS,
-            stdout=stdout,
-            stderr=stderr,
-            cwd=REPO_PATH,
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=cwd,
+            start_new_session=True,
         )
+        pumps = [
+            start_pump(process.stdout, stdout),
+            start_pump(process.stderr, stderr),
+        ]
         test_id = get_test_id(self.service_name, self.test_name)
         PROCESS_POOL[test_id] = process
-        process.wait()
-        stdout.close()
-        stderr.close()
+        timer = start_kill_timer(process, timeout) if timeout else None
+        rusage = wait_process(process)
+        if timer:
+            timer.cancel()
+        self.set_usage(
+            rusage,
+            self.process_start_time + time.perf_counter() - monotonic_start,
+        )
+        for pump in pumps:
+            pump.join()
         self.return_code = process.returncode
+        if timer and timer.expired:
+            print(
+                f"{Fore.RED}[TIMEOUT] :: {self.test_name} - killed after {timeout:.0f}s"
+            )
+            stdout.write(TIMEOUT_MARKER.format(timeout))
+        stdout.close(failed=self.return_code != 0)
+        stderr.close(failed=self.return_code != 0)
 
     def pre_print(self):
         print(f"{Fore.BLUE}[RUNNING] :: {self.test_name}")
@@ -88,76 +304,310 @@ class TestDetail:
     def post_print(self):
         if self.return_code != 0:
             print(
-                f"{Fore.RED}[FAILED]  :: {self.test_name} - Execution Time: {self.elapsed_time} seconds - CPU Time: {self.process_elapsed_time} seconds"
+                f"{Fore.RED}[FAILED]  :: {self.test_name} - Execution Time: {self.elapsed_time}{self.usage}"
             )
         else:
             print(
-                f"{Fore.GREEN}[PASSED]  :: {self.test_name} - Execution Time: {self.elapsed_time} seconds - CPU Time: {self.process_elapsed_time} seconds"
+                f"{Fore.GREEN}[PASSED]  :: {self.test_name} - Execution Time: {self.elapsed_time}{self.usage}"
             )
 
-    def execute(self):
+    def execute(self, options=None, store=None):
         try:
             self.pre_print()
             self.pre_tests()
-            self.run()
+            self.run(options or RunOptions())
+            if self.aborted:
+                return
             self.post_tests()
+            if store:
+                store.record(self)
             self.post_print()
         except KeyboardInterrupt:
             pass
 
 
+class TestBatch:
+    """Runs several tests of one service in a single `go test -json` process.
+
+    The JSON event stream is demultiplexed back into the individual
+    TestDetail objects, so each test still gets its own return code,
+    timings and log files.
+    """
+
+    def __init__(self, service_name, test_details, options=None, store=None):
+        options = options or RunOptions()
+        self.service_name = service_name
+        self.test_details = {
+            test_detail.test_name: test_detail for test_detail in test_details
+        }
+        self.parallel = options.parallel
+        self.binary_cache = options.binary_cache
+        self.store = store
+        self.log_policy = options.log_policy
+        self.endpoint_pool = options.endpoint_pool
+        self.timeout_multiplier = options.timeout_multiplier
+        self.process_start_time = None
+        self.compile_time = None
+
+    @property
+    def estimated_duration(self):
+        estimates = [
+            test_detail.estimated_duration for test_detail in self.test_details.values()
+        ]
+        return max(max(estimates), sum(estimates) / min(self.parallel, len(estimates)))
+
+    @property
+    def timeout(self):
+        timeouts = [
+            test_detail.get_timeout(self.timeout_multiplier)
+            for test_detail in self.test_details.values()
+        ]
+        if None in timeouts:
+            return None
+        return max(max(timeouts), sum(timeouts) / min(self.parallel, len(timeouts)))
+
+    def get_test_detail(self, event):
+        test = event.get("Test")
+        if not test:
+            return None
+        test_name = test.split("/")[0][len(GO_TEST_PREFIX) :]
+        return self.test_details.get(test_name)
+
+    def start_test(self, test_detail, stdout_logs):
+        test_detail.pre_print()
+        test_detail.pre_tests()
+        test_detail.process_start_time = self.process_start_time
+        test_detail.compile_time = self.compile_time
+        stdout_logs[test_detail.test_name] = self.log_policy.open(
+            test_detail.stdout_log
+        )
+
+    def finish_test(self, test_detail, return_code, stdout_logs):
+        stdout_logs.pop(test_detail.test_name).close(failed=return_code != 0)
+        # the batch process keeps running, so abort() must not count this
+        # test among the ones it kills
+        PROCESS_POOL.pop(test_detail.test_id, None)
+        if test_detail.aborted:
+            return
+        test_detail.return_code = return_code
+        test_detail.post_tests()
+        if self.store:
+            self.store.record(test_detail)
+        test_detail.post_print()
+
+    def run(self):
+        command = get_batch_run_command(
+            self.service_name, list(self.test_details), self.parallel
+        )
+        cwd = REPO_PATH
+        binary = self.binary_cache.get(self.service_name) if self.binary_cache else None
+        if binary:
+            command = get_batch_binary_run_command(
+                binary, self.service_name, list(self.test_details), self.parallel
+            )
+            cwd = self.binary_cache.package_path(self.service_name)
+        TEST_ENV_PARAMS.update(os.environ.copy())
+        env = dict(TEST_ENV_PARAMS)
+        if not self.endpoint_pool:
+            self.run_process(command, env, cwd)
+            return
+        weight = len(self.test_details)
+        endpoint = self.endpoint_pool.acquire(weight)
+        env.update(self.endpoint_pool.get_env(endpoint))
+        try:
+            self.run_process(command, env, cwd)
+        finally:
+            self.endpoint_pool.release(endpoint, weight)
+
+    def print_usage(self, rusage, elapsed):
+        compile_time = format_seconds(self.compile_time or 0)
+        usage = format_usage(rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss)
+        print(
+            f"{Fore.CYAN}[BATCH]   :: {self.service_name} ({len(self.test_details)} tests) - Compile Time: {compile_time} - Execution Time: {format_seconds(elapsed)}{usage}"
+        )
+
+    def run_process(self, command, env, cwd):
+        stderr = tempfile.TemporaryFile(mode="w+")
+        self.process_start_time = time.time()
+        monotonic_start = time.perf_counter()
+        process = subprocess.Popen(
+            command,
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=stderr,
+            cwd=cwd,
+            text=True,
+            start_new_session=True,
+        )
+        for test_name in self.test_details:
+            PROCESS_POOL[get_test_id(self.service_name, test_name)] = process
+        timeout = self.timeout
+        timer = start_kill_timer(process, timeout) if timeout else None
+
+        stdout_logs = {}
+        finished = set()
+        package_output = []
+        for line in process.stdout:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                package_output.append(line)
+                continue
+            if self.compile_time is None and event.get("Action") in ("start", "run"):
+                # nothing is reported before the test binary starts running
+                self.compile_time = time.perf_counter() - monotonic_start
+            test_detail = self.get_test_detail(event)
+            if not test_detail:
+                if event.get("Output"):
+                    package_output.append(event["Output"])
+                continue
+            top_level = "/" not in event["Test"]
+            action = event.get("Action")
+            if action == "run" and top_level:
+                self.start_test(test_detail, stdout_logs)
+            elif test_detail.test_name not in stdout_logs:
+                continue
+            elif action == "output":
+                stdout_logs[test_detail.test_name].write(event["Output"])
+            elif action in ("pass", "fail", "skip") and top_level:
+                return_code = 1 if action == "fail" else 0
+                self.finish_test(test_detail, return_code, stdout_logs)
+                finished.add(test_detail.test_name)
+        rusage = wait_process(process)
+        if timer:
+            timer.cancel()
+        elapsed = time.perf_counter() - monotonic_start
+        if timer and timer.expired:
+            print(
+                f"{Fore.RED}[TIMEOUT] :: {self.service_name} batch - killed after {timeout:.0f}s"
+            )
+            package_output.append(TIMEOUT_MARKER.format(timeout))
+        # the usage covers the whole process, so it is recorded for the batch
+        # and the tests only get the process end time
+        for test_detail in self.test_details.values():
+            test_detail.set_usage(None, self.process_start_time + elapsed)
+
+        stderr.seek(0)
+        stderr_output = stderr.read()
+        stderr.close()
+        for test_name, test_detail in self.test_details.items():
+            if test_name not in finished:
+                # the test never reported a result, e.g. the package failed to build
+                if test_name not in stdout_logs:
+                    self.start_test(test_detail, stdout_logs)
+                stdout_logs[test_name].write("".join(package_output))
+                self.finish_test(test_detail, process.returncode or 1, stdout_logs)
+            stderr_log = self.log_policy.open(test_detail.stderr_log)
+            stderr_log.write(stderr_output)
+            stderr_log.close(failed=test_detail.return_code != 0)
+        if self.store:
+            self.store.update_usage(
+                self.test_details[test_name]
+                for test_name in finished
+                if not self.test_details[test_name].aborted
+            )
+        if self.store:
+            self.store.record_batch(
+                {
+                    "service_name": self.service_name,
+                    "worker": threading.current_thread().name,
+                    "tests": len(self.test_details),
+                    "process_start_time": self.process_start_time,
+                    "process_end_time": self.process_start_time + elapsed,
+                    "compile_time": self.compile_time,
+                    "cpu_user": rusage.ru_utime if rusage else None,
+                    "cpu_system": rusage.ru_stime if rusage else None,
+                    "max_rss_kb": rusage.ru_maxrss if rusage else None,
+                }
+            )
+        if rusage:
+            self.print_usage(rusage, elapsed)
+
+    def execute(self):
+        try:
+            self.run()
+        except KeyboardInterrupt:
+            pass
+
+
 class TestSummary:
     test_details = {}
     export_dict = {}
     summary = {}
-    report = {}
 
-    def __init__(self, test_list_file=None):
-        self.pickle_file = PICKLE_TEST_DETAILS_FILE
+    def __init__(self, test_list_file=None, scheduler=None, scrape=True):
         if test_list_file:
             self.test_list_file = test_list_file
         else:
             self.test_list_file = TEST_LIST_FILE
-        self.load()
-        self.pool = multiprocessing.dummy.Pool(processes=8)
+        self.store = ResultStore()
+        # read-only commands work off whatever the store holds
+        if scrape and self.store.is_empty():
+            self.scrape_tests()
+        self.scheduler = scheduler or Scheduler(processes=POOL_PROCESSES)
 
+    def handle_signals(self):
         signal.signal(signal.SIGINT, self.termination_handler)
         signal.signal(signal.SIGTERM, self.termination_handler)
 
     def termination_handler(self, signal, frame):
         print(f"Exiting gracefully with signal {signal}")
-        self.pool.close()
-        self.pool.terminate()
-        for test_id in PROCESS_POOL:
-            if PROCESS_POOL[test_id]:
-                print(f"{Fore.RED}[ABORTED]  :: {test_id}")
-                PROCESS_POOL[test_id].kill()
+        self.abort()
+        close_open_logs()
         print("All processes are killed...")
+        self.store.finish_run()
         sys.exit(0)
 
-    def save(self):
-        with open(self.pickle_file, "wb") as file:
-            pickle.dump(self.test_details, file)
-
-    def load(self):
-        if os.path.exists(self.pickle_file):
-            with open(self.pickle_file, "rb") as file:
-                self.test_details = pickle.load(file)
-        else:
-            self.scrape_tests()
-            self.save()
-
-    def scrape_tests(self):
+    def abort(self):
+        self.scheduler.stop()
+        # batches drop their tests from the pool as they finish
+        for test_id, process in list(PROCESS_POOL.items()):
+            if process and process.returncode is None:
+                print(f"{Fore.RED}[ABORTED]  :: {test_id}")
+                if test_id in self.test_details:
+                    self.test_details[test_id].aborted = True
+                kill_process_tree(process)
+
+    def load(self, where="1", parameters=()):
+        self.load_rows(self.store.iter_tests(where, parameters))
+
+    def load_rows(self, rows):
+        self.test_details = {}
+        for row in rows:
+            test_detail = TestDetail.from_row(row)
+            self.test_details[test_detail.test_id] = test_detail
+        # failed attempts end early or run into their timeout, so only
+        # passed ones feed estimates and timeouts
+        durations = self.store.get_durations(self.test_details, passed=True)
+        for test_id, test_durations in durations.items():
+            self.test_details[test_id].durations = test_durations
+
+    def scrape_tests(self, jobs=SCRAPE_JOBS):
         if not os.path.exists(REPO_PATH):
             raise Exception(f"Path {REPO_PATH} does not exist.")
-        for path in glob.glob(TEST_DIR_REGEX):
-            service_name = path.split("/")[-2]
-            for i, line in enumerate(open(path)):
-                for match in re.finditer(GO_PATTERN, line):
-                    test_name = match[1].split("(")[0]
-                    test_id = get_test_id(service_name, test_name)
-                    if not self.test_details.get(test_id):
-                        self.test_details[test_id] = TestDetail(service_name, test_name)
+        discovery_index = DiscoveryIndex()
+        changed, removed = discovery_index.refresh(jobs=jobs)
+        self.sync_discovery(discovery_index)
+        print(
+            f"Scraped {len(discovery_index.entries)} test files ({len(changed)} changed, {len(removed)} removed)."
+        )
+
+    def sync_discovery(self, discovery_index):
+        test_files = {
+            path: os.path.relpath(path, REPO_PATH) for path in discovery_index.entries
+        }
+        self.store.sync_tests(
+            [
+                (
+                    get_test_id(service_name, test_name),
+                    service_name,
+                    test_name,
+                    test_files[path],
+                )
+                for service_name, test_name, path in discovery_index.tests()
+            ]
+        )
+        discovery_index.save()
 
     def export_test_details(self):
         self.generate_internal_dict()
@@ -171,166 +621,294 @@ class TestSummary:
 
     def generate_internal_dict(self, force=False):
         if len(self.export_dict) == 0 or force:
-            for test in self.test_details.values():
-                if not self.export_dict.get(test.service_name):
-                    self.export_dict[test.service_name] = []
-                self.export_dict[test.service_name].append(test.test_name)
+            for row in self.store.query(
+                "SELECT service_name, test_name FROM tests ORDER BY rowid"
+            ):
+                if not self.export_dict.get(row["service_name"]):
+                    self.export_dict[row["service_name"]] = []
+                self.export_dict[row["service_name"]].append(row["test_name"])
+
+    def get_candidates(self, services, pattern=None):
+        candidates = []
+        for service in services:
+            for test_name in self.export_dict.get(service, []):
+                if pattern and not re.search(pattern, test_name):
+                    continue
+                candidates.append(self.test_details[get_test_id(service, test_name)])
+        return candidates
+
+    def select_changed(self, candidates, changed_since):
+        impact = ChangeImpact(changed_since, get_changed_files(changed_since))
+        impact.resolve(self.store)
+        impact.print_changes()
+        selected = []
+        reasons = collections.Counter()
+        for test_detail in candidates:
+            reason = impact.get_reason(test_detail)
+            reasons[reason or "unaffected"] += 1
+            if reason:
+                selected.append(test_detail)
+        details = ", ".join(
+            f"{count} {reason}"
+            for reason, count in reasons.items()
+            if reason != "unaffected"
+        )
+        print(
+            f"Selected {len(selected)} of {len(candidates)} tests ({details or 'nothing affected'}), skipped {reasons['unaffected']} unaffected by changes since {changed_since}"
+        )
+        return selected
+
+    def select_tests(
+        self,
+        services,
+        pattern=None,
+        force_run=False,
+        shard=None,
+        rerun_failed=False,
+        changed_since=None,
+    ):
+        candidates = self.get_candidates(services, pattern)
+        if changed_since:
+            candidates = self.select_changed(candidates, changed_since)
+            # affected tests run again even if they completed before
+            force_run = True
+        if shard:
+            index, count = shard
+            candidates, load = shard_tests(candidates, count)[index - 1]
+            predicted = f", predicted {format_duration(load)}" if load else ""
+            print(f"Shard {index}/{count}: {len(candidates)} tests{predicted}")
+        selected = []
+        for test_detail in candidates:
+            if rerun_failed:
+                skip = not test_detail.completed or test_detail.return_code == 0
+            else:
+                skip = test_detail.completed and not force_run
+            if skip:
+                print(f"[SKIP]    :: {test_detail.test_name}")
+                continue
+            selected.append(test_detail)
+        return selected
 
-    def execute_tests(self, service, pattern=None, force_run=False):
+    def get_shard_matrix(self, services, shard_count, pattern=None):
         self.generate_internal_dict()
-        print("Creating execution pool...")
-        pool_args = []
-        
-        # this for loop is just for increasing speed of execution of in CI
-        init_start = time.time()
-        print("Speeding up test init...")
-        for test_name in self.export_dict[service]:
-            test_id = get_test_id(service, test_name)
-            test_detail = self.test_details.get(test_id)
-            command = get_test_run_command(test_detail.service_name, test_detail.test_name)
-            TEST_ENV_PARAMS.update(os.environ.copy())
-            subprocess.run(
-                command,
-                env=TEST_ENV_PARAMS,
-                cwd=REPO_PATH,
+        self.load(
+            f"service_name IN ({', '.join('?' for _ in services)})", tuple(services)
+        )
+        candidates = self.get_candidates(services, pattern)
+        matrix = []
+        for index, (tests, load) in enumerate(shard_tests(candidates, shard_count)):
+            predicted = f", predicted {format_duration(load)}" if load else ""
+            print(
+                f"Shard {index + 1}/{shard_count}: {len(tests)} tests{predicted}",
+                file=sys.stderr,
             )
-            break
-
-        init_end = time.time()
-        init_duration = time.strftime("%Mm %Ss", time.gmtime(init_end - init_start))
-        print(f"Test init speed up complete {init_duration}.")
-        
-
-        for test_name in self.export_dict[service]:
-            test_id = get_test_id(service, test_name)
-            test_detail = self.test_details.get(test_id)
-            if self.test_details[test_id].completed and not force_run:
-                print(f"[SKIP]    :: {test_detail.test_name}")
-                continue
-            if service and service == test_detail.service_name and pattern:
-                if re.search(pattern, test_name):
-                    pool_args.append(test_detail)
-                    continue
-            pool_args.append(test_detail)
+            matrix.append(f"{index + 1}/{shard_count}")
+        return matrix
+
+    def execute_tests(
+        self,
+        services,
+        pattern=None,
+        force_run=False,
+        shard=None,
+        rerun_failed=False,
+        changed_since=None,
+        options=None,
+    ):
+        options = options or RunOptions()
+        if changed_since:
+            # test files of origin must be current to map changes onto tests
+            self.scrape_tests()
+        self.generate_internal_dict()
+        self.load(
+            f"service_name IN ({', '.join('?' for _ in services)})", tuple(services)
+        )
+        print("Creating execution pool...")
+        pool_args = self.select_tests(
+            services, pattern, force_run, shard, rerun_failed, changed_since
+        )
+        if options.warmup:
+            work = collections.Counter()
+            for test_detail in pool_args:
+                work[test_detail.service_name] += test_detail.estimated_duration
+            options.warmup.prioritize([service for service, _ in work.most_common()])
+        quarantined = self.get_quarantined(pool_args)
+        self.store.start_run(services, get_revision())
         try:
             print(f"Added {len(pool_args)} tests in the pool")
-            self.pool.map(TestDetail.execute, pool_args)
+            for attempt in range(1, options.retries + 2):
+                for test_detail in pool_args:
+                    test_detail.attempt = attempt
+                self.schedule_tests(pool_args, options, quarantined)
+                pool_args = [
+                    test_detail
+                    for test_detail in pool_args
+                    if test_detail.return_code != 0
+                    and not test_detail.aborted
+                    and not (
+                        options.breaker
+                        and test_detail.service_name in options.breaker.tripped
+                    )
+                ]
+                if not pool_args or attempt > options.retries:
+                    break
+                print(
+                    f"{Fore.YELLOW}Retrying {len(pool_args)} failed tests (attempt {attempt + 1}/{options.retries + 1})"
+                )
             print("Pool Exited.")
+            self.print_flaky()
         except Exception as e:
             print("Exception - Pool Exited due to : ", e)
-            self.pool.close()
-            self.pool.terminate()
-            self.save()
+            self.scheduler.stop()
+            self.store.finish_run()
             sys.exit(1)
-        finally:
-            self.pool.close()
-            self.pool.terminate()
-            self.save()
-            sys.exit(0)
-
-    def generate_summary_dict(self):
-        for test_id in self.test_details:
-            test_detail = self.test_details.get(test_id)
-            if not self.summary.get(test_detail.service_name):
-                self.summary[test_detail.service_name] = {
-                    "passed": 0,
-                    "failed": 0,
-                    "total": 0,
-                    "completed": 0,
-                }
-            self.summary[test_detail.service_name]["total"] += 1
-            if not test_detail.completed:
-                continue
-            self.summary[test_detail.service_name]["completed"] += 1
-            if test_detail.return_code == 0:
-                self.summary[test_detail.service_name]["passed"] += 1
-            else:
-                self.summary[test_detail.service_name]["failed"] += 1
-
-    def generate_report_dict(self):
-        for test_id in self.test_details:
-            test_detail = self.test_details.get(test_id)
-
-            if not test_detail.completed:
-                continue
-
-            if not self.report.get(test_detail.service_name):
-                self.report[test_detail.service_name] = {}
-
-            if not self.report[test_detail.service_name].get(test_detail.test_name):
-                self.report[test_detail.service_name][test_detail.test_name] = {}
-
-            if test_detail.completed:
-                self.report[test_detail.service_name][test_detail.test_name][
-                    "return_code"
-                ] = test_detail.return_code
-                self.report[test_detail.service_name][test_detail.test_name][
-                    "elapsed_time"
-                ] = test_detail.elapsed_time
-                self.report[test_detail.service_name][test_detail.test_name][
-                    "process_elapsed_time"
-                ] = test_detail.process_elapsed_time
+        self.scheduler.stop()
+        self.store.finish_run()
+
+    def get_quarantined(self, test_details):
+        flaky = self.store.get_flaky_tests()
+        quarantined = {
+            test_detail.test_id
+            for test_detail in test_details
+            if test_detail.test_id in flaky
+        }
+        if quarantined:
+            print(
+                f"{Fore.YELLOW}Quarantined {len(quarantined)} flaky tests, they run last"
+            )
+            for test_id in sorted(quarantined):
+                print(
+                    f"{Fore.YELLOW}[QUARANTINE] :: {test_id} (flaky in {flaky[test_id]} recent runs)"
+                )
+        return quarantined
 
-    def generate_report(self):
-        self.generate_report_dict()
-        self.generate_summary_dict()
+    def print_flaky(self):
+        for test_detail in self.test_details.values():
+            if test_detail.attempt > 1 and test_detail.return_code == 0:
+                print(
+                    f"{Fore.YELLOW}[FLAKY]   :: {test_detail.test_name} - passed on attempt {test_detail.attempt}"
+                )
 
-        report = open(TEST_REPORT_FILENAME, "w")
-        report.write(
-            f"""<link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/bootstrap@4.1.3/dist/css/bootstrap.min.css" integrity="sha384-MCw98/SFnGE8fJT3GXwEOngsV7Zt27NXFoaoApmYm81iuXoPkFOJwJ8ERdknLPMO" crossorigin="anonymous">\n"""
-        )
-        report.write(f"<body class='p-4'>")
-        for service_name in self.report:
-            report.write(f"<h3>{service_name}</h3>\n")
-
-            # report summary
-            report.write(f"<table border='1' class='table'>\n")
-            report.write(
-                f"<tr><th>Total:</th><td>{self.summary[service_name]['total']}</td></tr>\n"
+    def schedule_tests(self, pool_args, options=None, quarantined=()):
+        options = options or RunOptions()
+        caps = dict(options.service_caps)
+        caps[QUARANTINE_GROUP] = options.quarantine_jobs
+
+        def get_group(test_detail):
+            # quarantined tests still count against their service's cap and
+            # are dropped with it by the circuit breaker
+            if test_detail.test_id in quarantined:
+                return test_detail.service_name, QUARANTINE_GROUP
+            return test_detail.service_name
+
+        batch_size = options.batch_size
+        if batch_size > 0:
+            service_args = {}
+            for test_detail in pool_args:
+                key = (test_detail.service_name, get_group(test_detail))
+                service_args.setdefault(key, []).append(test_detail)
+            items = [
+                TestBatch(service, tests[i : i + batch_size], options, self.store)
+                for (service, _), tests in service_args.items()
+                for i in range(0, len(tests), batch_size)
+            ]
+            print(f"Grouped tests into {len(items)} batches")
+            function = TestBatch.execute
+            get_tests = lambda batch: list(batch.test_details.values())
+        else:
+            items = pool_args
+            function = functools.partial(
+                TestDetail.execute, options=options, store=self.store
             )
-            report.write(
-                f"<tr><th>Passed:</th><td>{self.summary[service_name]['passed']}</td></tr>\n"
+            get_tests = lambda test_detail: [test_detail]
+
+        def run_item(item):
+            if options.warmup:
+                options.warmup.wait(get_tests(item)[0].service_name)
+            function(item)
+            if options.breaker:
+                self.check_breaker(options.breaker, get_tests(item), get_tests)
+
+        self.scheduler.map(
+            run_item,
+            items,
+            estimate=lambda item: item.estimated_duration,
+            group=lambda item: get_group(get_tests(item)[0]),
+            caps=caps,
+            fair=options.fair,
+            deferred=[QUARANTINE_GROUP],
+        )
+
+    def check_breaker(self, breaker, test_details, get_tests):
+        for test_detail in test_details:
+            if test_detail.return_code is None:
+                continue
+            reason = breaker.record(
+                test_detail.service_name, test_detail.return_code != 0
             )
-            report.write(
-                f"<tr><th>Failed:</th><td>{self.summary[service_name]['failed']}</td></tr>\n"
+            if not reason:
+                continue
+            dropped = sum(
+                len(get_tests(item))
+                for item in self.scheduler.drop_group(test_detail.service_name)
             )
-            report.write(
-                f"<tr><th>Completed:</th><td>{self.summary[service_name]['completed']}</td></tr>\n"
+            print(
+                f"{Fore.RED}[BREAKER] :: {test_detail.service_name} - {reason}, skipping its {dropped} remaining tests"
             )
-            report.write(f"</table>\n")
 
-            # report tests
-            report.write(f"<table border='1' class='table'>\n")
-            report.write(
-                f"<tr><th>Test Name</th><th>Status</th><th>Duration</th><th>out</th><th>err</th></tr>\n"
-            )
-            for test_name in self.report[service_name]:
-                test_id = get_test_id(service_name, test_name)
-                test_detail = self.test_details.get(test_id)
-
-                status = "PASSED" if test_detail.return_code == 0 else "FAILED"
-                color = "red" if status == "FAILED" else "green"
-                elapsed_time = test_detail.elapsed_time
-
-                out_log = f"<a href='/{test_detail.logfile_path}/{test_detail.test_name}_stdout.log'>stdout</a>"
-                err_log = f"<a href='/{test_detail.logfile_path}/{test_detail.test_name}_stderr.log'>stderr</a>"
-                report.write(
-                    f"<tr style='color: {color}'><td>{test_name}</td><td>{status}</td><td>{elapsed_time}</td><td>{out_log}</td><td>{err_log}</td></tr>\n"
-                )
+    def generate_summary_dict(self, service_name=None):
+        for row in self.store.get_summary(service_name):
+            self.summary[row["service_name"]] = {
+                "passed": row["passed"],
+                "failed": row["failed"],
+                "total": row["total"],
+                "completed": row["completed"],
+            }
 
-        report.write("</table></body>\n")
-        report.close()
+    def generate_report(self):
+        # the page stays a static shell fetching report.json; over file://,
+        # where browsers refuse to fetch, it loads the same data as report.js
+        shutil.copyfile(TEST_REPORT_TEMPLATE, TEST_REPORT_FILENAME)
+        with open(TEST_REPORT_DATA_FILENAME, "w") as report_data, open(
+            TEST_REPORT_SCRIPT_FILENAME, "w"
+        ) as report_script:
+            report_script.write("window.REPORT_DATA = ")
+
+            def write(text):
+                report_data.write(text)
+                report_script.write(text)
+
+            write("[")
+            separator = "\n"
+            for row, trend in self.store.iter_tests_with_durations(
+                SPARKLINE_SIZE, order="service_name, rowid"
+            ):
+                duration = None
+                status = "PENDING"
+                if row["completed"]:
+                    duration = round(row["end_time"] - row["start_time"], 3)
+                    status = "PASSED" if row["return_code"] == 0 else "FAILED"
+                record = {
+                    "service": row["service_name"],
+                    "test": row["test_name"],
+                    "status": status,
+                    "duration": duration,
+                    "trend": [round(duration, 3) for duration in trend],
+                }
+                write(separator + json.dumps(record, separators=(",", ":")))
+                separator = ",\n"
+            write("\n]")
+            report_data.write("\n")
+            report_script.write(";\n")
         print("Test Reports Exported.")
 
     def get_test_details(self, service_name, test_filename, test_name):
-        test_id = get_test_id(service_name, test_filename, test_name)
-        print(self.test_details.get(test_id).__dict__)
+        row = self.store.get_test(service_name, test_name)
+        print(dict(row) if row else None)
 
     def print_summary(self, service_name):
-        self.generate_summary_dict()
+        self.generate_summary_dict(service_name)
         for service in self.summary:
-            if service_name and service_name != service:
-                continue
             print(f"-----{service}-----")
             print(f"Total: {self.summary[service]['total']}")
             print(f"Completed: {self.summary[service]['completed']}")
@@ -338,36 +916,35 @@ class TestSummary:
             print(f"Failed: {self.summary[service]['failed']}")
 
     def get_services_list(self, all):
-        self.generate_internal_dict()
-        services = []
-        if all:
-            services = list(self.export_dict.keys())
-        else:
-            services = [
-                service
-                for service in self.export_dict.keys()
-                if service in SERVICES_TO_TEST
-            ]
+        services = self.store.get_services()
+        if not all:
+            services = [service for service in services if service in SERVICES_TO_TEST]
         return services
 
     def get_yaml(self, output_file):
-        self.generate_report_dict()
         file = open(output_file, "w")
-        for services in self.report:
-            file.write(f"{services}:\n")
-            for test_name in self.report[services]:
-                if self.report[services][test_name]["return_code"] == 0:
-                    file.write(f"    - TestAcc{test_name}\n")
+        service_name = None
+        for row in self.store.iter_tests("completed = 1", order="service_name, rowid"):
+            if row["service_name"] != service_name:
+                service_name = row["service_name"]
+                file.write(f"{service_name}:\n")
+            if row["return_code"] == 0:
+                file.write(f"    - TestAcc{row['test_name']}\n")
         file.close()
 
-    def list_tests(self, pattern):
-        for test_id in self.test_details:
-            test_detail = self.test_details[test_id]
-            if pattern in test_detail.test_name:
-                print(test_detail.test_name)
-
-    def local(self, pattern):
-        for test_id in self.test_details:
-            test_detail = self.test_details[test_id]
-            if pattern in test_detail.test_name:
-                test_detail.execute()
+    def list_tests(self, pattern, mode="substring", service_name=None):
+        for row in self.store.search_tests(pattern, mode, service_name):
+            print(row["test_name"])
+
+    def local(self, pattern, mode="substring", service_name=None, options=None):
+        if not pattern and not service_name:
+            # an empty selection would run every test of the store
+            raise ValueError("A local run needs a pattern or a service name")
+        self.load_rows(self.store.search_tests(pattern, mode, service_name))
+        pool_args = list(self.test_details.values())
+        self.store.start_run(
+            sorted({test.service_name for test in pool_args}), get_revision()
+        )
+        print(f"Added {len(pool_args)} tests in the pool")
+        self.schedule_tests(pool_args, options)
+        self.store.finish_run()
@@ -0,0 +1,261 @@
+import email.utils
+import functools
+import gzip
+import http.server
+import os
+import re
+import urllib.parse
+import zlib
+from constants import (
+    HTTP_SERVER_HOST,
+    HTTP_SERVER_PORT,
+    REPORT_SERVER_GZIP_MAX_MB,
+    ROOT_DIR,
+)
+
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript")
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+# uncompressed sizes of logs by path, valid while mtime and size stay the same
+GZIP_SIZES = {}
+
+
+def get_gzip_size(path, stat):
+    """Uncompressed size of a gzip log, measured by decompressing it.
+
+    The ISIZE trailer only holds the size modulo 2**32 and is missing from a
+    log still being written, whose size is what can be decompressed so far.
+    """
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = GZIP_SIZES.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+    size = 0
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    with open(path, "rb") as file:
+        for data in iter(lambda: file.read(COPY_BUFFER_SIZE), b""):
+            while data:
+                if decompressor.eof:
+                    # next member of a concatenated gzip file
+                    data = decompressor.unused_data + data
+                    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                try:
+                    size += len(decompressor.decompress(data, COPY_BUFFER_SIZE))
+                except zlib.error:
+                    break
+                data = decompressor.unconsumed_tail
+    GZIP_SIZES[path] = (key, size)
+    return size
+
+
+def parse_range(value, size):
+    match = RANGE_PATTERN.match(value.strip())
+    if not match or match.group(1) == match.group(2) == "":
+        return None
+    start, end = match.group(1), match.group(2)
+    if start == "":
+        start, end = max(0, size - int(end)), size - 1
+    else:
+        start, end = int(start), min(int(end) if end else size - 1, size - 1)
+    if start > end:
+        return None
+    return start, end
+
+
+class ReportRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves the report and its logs.
+
+    Supports gzip content-encoding, single byte-range requests, zero-copy
+    `sendfile` transfers and `?tail=N` / `?range=a-b` slices of a log.
+    Logs stored as `<name>.gz` are served under their uncompressed name and
+    decompressed on the fly when the client cannot take gzip or asks for a
+    slice of them.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.serve(head=False)
+
+    def do_HEAD(self):
+        self.serve(head=True)
+
+    def accepts_gzip(self):
+        # gzip;q=0 refuses gzip, and `*` stands for any coding not listed
+        qualities = {}
+        for coding in self.headers.get("Accept-Encoding", "").split(","):
+            name, *parameters = [part.strip() for part in coding.split(";")]
+            quality = 1.0
+            for parameter in parameters:
+                key, _, value = parameter.partition("=")
+                if key.strip().lower() == "q":
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            if name:
+                qualities[name.lower()] = quality
+        return qualities.get("gzip", qualities.get("*", 0.0)) > 0
+
+    def get_slice(self, query, size):
+        if "tail" in query:
+            tail = int(query["tail"][0])
+            if tail < 0:
+                raise ValueError(f"negative tail {tail}")
+            return max(0, size - tail), size - 1
+        if "range" in query:
+            byte_slice = parse_range(f"bytes={query['range'][0]}", size)
+            if byte_slice is None:
+                raise ValueError(f"unsatisfiable range {query['range'][0]}")
+            return byte_slice
+        return None
+
+    def serve(self, head):
+        url = urllib.parse.urlsplit(self.path)
+        path = self.translate_path(url.path)
+        if os.path.isdir(path):
+            if head:
+                return super().do_HEAD()
+            return super().do_GET()
+
+        compressed = path.endswith(".log.gz")
+        if not os.path.isfile(path) and os.path.isfile(path + ".gz"):
+            path, compressed = path + ".gz", True
+        if not os.path.isfile(path):
+            self.send_error(404, "File not found")
+            return
+
+        content_type = (
+            "text/plain; charset=utf-8" if compressed else self.guess_type(path)
+        )
+        stat = os.stat(path)
+        size = get_gzip_size(path, stat) if compressed else stat.st_size
+        query = urllib.parse.parse_qs(url.query)
+        try:
+            byte_slice = self.get_slice(query, size)
+        except ValueError:
+            self.send_error(400, "Invalid slice")
+            return
+        partial = False
+        if byte_slice is None and "Range" in self.headers:
+            byte_slice = parse_range(self.headers["Range"], size)
+            if byte_slice is None:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            partial = True
+
+        if byte_slice is None and compressed and self.accepts_gzip():
+            self.send_file(path, stat, content_type, head, encoding="gzip")
+        elif byte_slice is None and compressed:
+            self.send_decompressed(path, stat, content_type, head, 0, size)
+        elif compressed:
+            start, end = byte_slice
+            self.send_decompressed(
+                path, stat, content_type, head, start, end - start + 1, partial, size
+            )
+        elif byte_slice is not None:
+            start, end = byte_slice
+            self.send_file(
+                path, stat, content_type, head, None, start, end - start + 1, partial
+            )
+        elif (
+            self.accepts_gzip()
+            and content_type.startswith(COMPRESSIBLE_TYPES)
+            and size <= REPORT_SERVER_GZIP_MAX_MB * 1024 * 1024
+        ):
+            self.send_gzipped(path, stat, content_type, head)
+        else:
+            self.send_file(path, stat, content_type, head)
+
+    def send_common_headers(
+        self, stat, content_type, length, partial=False, start=0, size=None
+    ):
+        self.send_response(206 if partial else 200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header(
+            "Last-Modified", email.utils.formatdate(stat.st_mtime, usegmt=True)
+        )
+        if partial:
+            self.send_header(
+                "Content-Range", f"bytes {start}-{start + length - 1}/{size}"
+            )
+
+    def send_file(
+        self,
+        path,
+        stat,
+        content_type,
+        head,
+        encoding=None,
+        start=0,
+        length=None,
+        partial=False,
+    ):
+        if length is None:
+            length = stat.st_size
+        self.send_common_headers(
+            stat, content_type, length, partial, start, stat.st_size
+        )
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+            self.send_header("Vary", "Accept-Encoding")
+        self.end_headers()
+        if head or length == 0:
+            return
+        with open(path, "rb") as file:
+            self.wfile.flush()
+            self.connection.sendfile(file, start, length)
+
+    def send_gzipped(self, path, stat, content_type, head):
+        with open(path, "rb") as file:
+            body = gzip.compress(file.read(), compresslevel=6)
+        self.send_common_headers(stat, content_type, len(body))
+        self.send_header("Content-Encoding", "gzip")
+        self.send_header("Vary", "Accept-Encoding")
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def send_decompressed(
+        self, path, stat, content_type, head, start, length, partial=False, size=None
+    ):
+        self.send_common_headers(stat, content_type, length, partial, start, size)
+        # the same log goes out gzipped to clients accepting it
+        self.send_header("Vary", "Accept-Encoding")
+        self.end_headers()
+        if head:
+            return
+        with gzip.open(path, "rb") as file:
+            file.seek(start)
+            while length > 0:
+                try:
+                    chunk = file.read(min(COPY_BUFFER_SIZE, length))
+                except EOFError:
+                    # the log is still being written and has no trailer yet
+                    chunk = b""
+                if not chunk:
+                    # the promised length cannot be delivered, so end the connection
+                    self.close_connection = True
+                    break
+                self.wfile.write(chunk)
+                length -= len(chunk)
+
+
+def run_report_server(host=HTTP_SERVER_HOST, port=HTTP_SERVER_PORT):
+    handler = functools.partial(ReportRequestHandler, directory=ROOT_DIR)
+    web_server = http.server.ThreadingHTTPServer((host, port), handler)
+    web_server.daemon_threads = True
+    try:
+        print(f"Starting webserver at: http://{host}:{port}")
+        web_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    web_server.server_close()
+    print("Server stopped")
@@ -0,0 +1,359 @@
+import collections
+import heapq
+import os
+import threading
+import time
+from colorama import Fore
+from constants import (
+    ADAPTIVE_INTERVAL,
+    ADAPTIVE_LATENCY_HIGH,
+    ADAPTIVE_LATENCY_LOW,
+    ADAPTIVE_LOAD_HIGH,
+    ADAPTIVE_LOAD_LOW,
+    ADAPTIVE_MEMORY_LOW_MB,
+    BREAKER_CONSECUTIVE_FAILURES,
+    BREAKER_FAILURE_RATE,
+    BREAKER_MIN_TESTS,
+    POOL_PROCESSES,
+)
+from utils import get_health_latency
+
+
+def format_duration(seconds):
+    return time.strftime("%Hh %Mm %Ss", time.gmtime(seconds))
+
+
+def get_names(group):
+    return group if isinstance(group, tuple) else (group,)
+
+
+def predict_makespan(estimates, processes):
+    workers = [0.0] * min(processes, len(estimates))
+    if not workers:
+        return 0.0
+    for estimate in estimates:
+        heapq.heappush(workers, heapq.heappop(workers) + estimate)
+    return max(workers)
+
+
+def shard_tests(test_details, shard_count):
+    """Deterministically splits tests into `shard_count` shards of balanced
+    predicted runtime, assigning the longest tests first to the least loaded
+    shard. Without any recorded durations every test weighs the same.
+    """
+    has_history = any(test_detail.durations for test_detail in test_details)
+    weights = {
+        test_detail.test_id: test_detail.estimated_duration if has_history else 1
+        for test_detail in test_details
+    }
+    shards = [(0, index, []) for index in range(shard_count)]
+    for test_detail in sorted(
+        test_details, key=lambda test: (-weights[test.test_id], test.test_id)
+    ):
+        load, index, tests = heapq.heappop(shards)
+        tests.append(test_detail)
+        heapq.heappush(shards, (load + weights[test_detail.test_id], index, tests))
+    shards = sorted(shards, key=lambda shard: shard[1])
+    return [(tests, load if has_history else None) for load, _, tests in shards]
+
+
+def get_available_memory_mb():
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+class ConcurrencyController:
+    """Grows or shrinks the number of running tests between min and max.
+
+    Every interval it samples the load average per CPU, the available
+    memory and the LocalStack health probe latency (of the slowest healthy
+    endpoint with an EndpointPool). Any pressure signal removes a slot,
+    while all-clear signals add one back.
+    """
+
+    def __init__(
+        self,
+        min_processes,
+        max_processes,
+        interval=ADAPTIVE_INTERVAL,
+        endpoint_pool=None,
+    ):
+        if not 1 <= min_processes <= max_processes:
+            # the limit could never leave the range, or no test would start
+            raise ValueError(
+                f"Concurrency range {min_processes}-{max_processes} is not 1 <= min <= max"
+            )
+        self.min_processes = min_processes
+        self.max_processes = max_processes
+        self.interval = interval
+        self.endpoint_pool = endpoint_pool
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def initial_limit(self):
+        return min(max(POOL_PROCESSES, self.min_processes), self.max_processes)
+
+    def sample(self):
+        load = os.getloadavg()[0] / (os.cpu_count() or 1)
+        memory = get_available_memory_mb()
+        if self.endpoint_pool:
+            latency = self.endpoint_pool.latency
+        else:
+            latency = get_health_latency()
+        return load, memory, latency
+
+    def decide(self, limit, load, memory, latency):
+        if (
+            latency is None
+            or latency > ADAPTIVE_LATENCY_HIGH
+            or load > ADAPTIVE_LOAD_HIGH
+            or memory < ADAPTIVE_MEMORY_LOW_MB
+        ):
+            return max(limit - 1, self.min_processes)
+        if latency < ADAPTIVE_LATENCY_LOW and load < ADAPTIVE_LOAD_LOW:
+            return min(limit + 1, self.max_processes)
+        return limit
+
+    def control(self, scheduler):
+        while not self.stopped.wait(self.interval):
+            load, memory, latency = self.sample()
+            limit = self.decide(scheduler.limit, load, memory, latency)
+            if limit == scheduler.limit:
+                continue
+            latency = f"{latency:.2f}s" if latency is not None else "unreachable"
+            print(
+                f"{Fore.YELLOW}[CONCURRENCY] :: {scheduler.limit} -> {limit} (load/cpu {load:.2f}, memory {memory:.0f}MB, localstack {latency})"
+            )
+            scheduler.set_limit(limit)
+
+    def start(self, scheduler):
+        self.stopped.clear()
+        self.thread = threading.Thread(
+            target=self.control, args=(scheduler,), daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+
+class CircuitBreaker:
+    """Trips for a service once its tests fail too often, e.g. when
+    LocalStack support for that service is broken, so the rest of its tests
+    can be dropped instead of holding workers."""
+
+    def __init__(
+        self,
+        consecutive_failures=BREAKER_CONSECUTIVE_FAILURES,
+        failure_rate=BREAKER_FAILURE_RATE,
+        min_tests=BREAKER_MIN_TESTS,
+    ):
+        self.consecutive_failures = consecutive_failures
+        self.failure_rate = failure_rate
+        self.min_tests = min_tests
+        self.ran = collections.Counter()
+        self.failed = collections.Counter()
+        self.consecutive = collections.Counter()
+        self.tripped = set()
+        self.lock = threading.Lock()
+
+    def record(self, service_name, failed):
+        """Counts a result and returns the reason when it trips the breaker."""
+        with self.lock:
+            if service_name in self.tripped:
+                return None
+            self.ran[service_name] += 1
+            self.failed[service_name] += failed
+            self.consecutive[service_name] = (
+                self.consecutive[service_name] + 1 if failed else 0
+            )
+            ran, failed = self.ran[service_name], self.failed[service_name]
+            if self.consecutive_failures and (
+                self.consecutive[service_name] >= self.consecutive_failures
+            ):
+                reason = f"{self.consecutive[service_name]} failures in a row"
+            elif (
+                self.failure_rate
+                and ran >= self.min_tests
+                and (failed / ran >= self.failure_rate)
+            ):
+                reason = f"{failed}/{ran} tests failed"
+            else:
+                return None
+            self.tripped.add(service_name)
+            return reason
+
+
+class Scheduler:
+    """Longest-job-first scheduler over a set of worker threads.
+
+    Work items are ordered by their estimated duration and pulled one at a
+    time from a shared queue, so an idle worker always picks up the next
+    longest item instead of waiting on a statically assigned chunk. With a
+    ConcurrencyController the number of items running at once follows the
+    controller's limit instead of the thread count.
+
+    Items can be grouped (e.g. by service). Groups share the same workers,
+    may be capped in how many of their items run at once, and with `fair`
+    the group with the fewest running items is served first. Deferred
+    groups are only served when no other group has an item to start. An
+    item's group may be a tuple of groups, e.g. its service plus
+    quarantine, in which case it counts against the cap of each of them.
+    """
+
+    def __init__(self, processes=POOL_PROCESSES, controller=None):
+        self.controller = controller
+        if controller:
+            self.processes = controller.max_processes
+            self.limit = controller.initial_limit()
+        else:
+            self.processes = processes
+            self.limit = processes
+        self.queues = {}
+        self.running = collections.Counter()
+        self.caps = {}
+        self.fair = False
+        self.deferred = set()
+        self.condition = threading.Condition()
+        self.error = None
+
+    def set_limit(self, limit):
+        with self.condition:
+            self.limit = limit
+            self.condition.notify_all()
+
+    def get_cap(self, group):
+        return self.caps.get(group, self.caps.get(None))
+
+    def is_capped(self, group):
+        for name in get_names(group):
+            cap = self.get_cap(name)
+            if cap is not None and self.running[name] >= cap:
+                return True
+        return False
+
+    def pick_group(self):
+        picked = None
+        for group, queue in self.queues.items():
+            if self.is_capped(group):
+                continue
+            names = get_names(group)
+            key = (
+                not self.deferred.intersection(names),
+                -self.running[names[0]] if self.fair else 0,
+                queue[0][0],
+            )
+            if picked is None or key > picked[0]:
+                picked = (key, group)
+        return picked[1] if picked else None
+
+    def next_item(self):
+        with self.condition:
+            while True:
+                if not self.queues:
+                    return None, None
+                if sum(self.running.values()) < self.limit:
+                    group = self.pick_group()
+                    if group is not None:
+                        break
+                self.condition.wait()
+            queue = self.queues[group]
+            _, item = queue.popleft()
+            if not queue:
+                del self.queues[group]
+            for name in get_names(group):
+                self.running[name] += 1
+            return group, item
+
+    def done_item(self, group):
+        with self.condition:
+            for name in get_names(group):
+                self.running[name] -= 1
+            self.condition.notify_all()
+
+    def worker(self, function):
+        group, item = self.next_item()
+        while item is not None:
+            try:
+                function(item)
+            except Exception as e:
+                self.error = e
+                self.stop()
+            finally:
+                self.done_item(group)
+            group, item = self.next_item()
+
+    def stop(self):
+        with self.condition:
+            self.queues.clear()
+            self.condition.notify_all()
+
+    def drop_group(self, group):
+        """Removes the queued items of a group, including those of every
+        tuple of groups it is part of, and returns them."""
+        dropped = []
+        with self.condition:
+            for key in list(self.queues):
+                if group in get_names(key):
+                    dropped += [item for _, item in self.queues.pop(key)]
+            self.condition.notify_all()
+        return dropped
+
+    def map(
+        self,
+        function,
+        items,
+        estimate,
+        group=None,
+        caps=None,
+        fair=False,
+        deferred=(),
+    ):
+        for cap_group, cap in (caps or {}).items():
+            if cap < 1:
+                # no item of the group could ever start and workers would
+                # wait for it forever
+                raise ValueError(f"Cap of {cap_group or 'every group'} is {cap}")
+        estimates = {id(item): estimate(item) for item in items}
+        items = sorted(items, key=lambda item: estimates[id(item)], reverse=True)
+        predicted = predict_makespan(
+            [estimates[id(item)] for item in items], self.limit
+        )
+        print(f"Predicted makespan: {format_duration(predicted)}")
+
+        start_time = time.time()
+        with self.condition:
+            self.error = None
+            self.caps = caps or {}
+            self.fair = fair
+            self.deferred = set(deferred)
+            for item in items:
+                item_group = group(item) if group else None
+                queue = self.queues.setdefault(item_group, collections.deque())
+                queue.append((estimates[id(item)], item))
+        workers = [
+            threading.Thread(
+                target=self.worker,
+                args=(function,),
+                name=f"worker-{index + 1}",
+                daemon=True,
+            )
+            for index in range(min(self.processes, len(items)))
+        ]
+        for worker in workers:
+            worker.start()
+        if self.controller:
+            self.controller.start(self)
+        for worker in workers:
+            worker.join()
+        if self.controller:
+            self.controller.stop()
+        print(f"Actual makespan: {format_duration(time.time() - start_time)}")
+        if self.error:
+            raise self.error
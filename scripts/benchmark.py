@@ -0,0 +1,278 @@
+"""Benchmarks goat's own overhead against a synthetic provider tree.
+
+A terraform-provider-aws shaped tree is generated for every size and a stub
+`go` executable is put first on PATH, so `go test` costs only what the stub
+is told to sleep and print. Every command runs in a fresh process and its
+wall time and max RSS are written as JSON; read-only commands, which are
+mostly interpreter and store startup, report the median of --repeat runs.
+
+    python scripts/benchmark.py --sizes 1000,10000,50000 --output benchmark.json
+"""
+
+import argparse
+import http.server
+import json
+import math
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+GOAT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GOAT_MAIN = os.path.join(GOAT_DIR, "main.py")
+
+STUB_GO = """#!{python}
+import json, os, sys, time, zlib
+
+args = sys.argv[1:]
+if args[:1] != ["test"] or "-c" in args:
+    sys.exit(0)
+package = next((arg for arg in args[1:] if arg.startswith("./")), ".")
+pattern = args[args.index("-run") + 1] if "-run" in args else ""
+if pattern.startswith("^"):
+    # batch pattern: ^TestAcc(a|b|c)$
+    names = pattern[len("^TestAcc("):-len(")$")].split("|")
+else:
+    names = [pattern]
+seconds = float(os.environ.get("GOAT_BENCH_TEST_SECONDS", "0"))
+lines = int(os.environ.get("GOAT_BENCH_OUTPUT_LINES", "0"))
+fail_every = int(os.environ.get("GOAT_BENCH_FAIL_EVERY", "0"))
+as_json = "-json" in args
+failed_any = False
+
+
+def emit(action, test, output=None):
+    if as_json:
+        event = {{"Action": action, "Package": package, "Test": test}}
+        if output is not None:
+            event["Output"] = output
+        sys.stdout.write(json.dumps(event) + "\\n")
+    elif output is not None:
+        sys.stdout.write(output)
+
+
+for name in names:
+    test = "TestAcc" + name
+    emit("run", test, f"=== RUN   {{test}}\\n")
+    time.sleep(seconds)
+    for line in range(lines):
+        emit("output", test, f"    {{name}}_test.go:{{line}}: synthetic output line {{line}}\\n")
+    failed = fail_every > 0 and zlib.crc32(name.encode()) % fail_every == 0
+    failed_any = failed_any or failed
+    result = "FAIL" if failed else "PASS"
+    emit("output", test, f"--- {{result}}: {{test}} ({{seconds:.2f}}s)\\n")
+    emit("fail" if failed else "pass", test)
+sys.exit(1 if failed_any else 0)
+"""
+
+
+def generate_tree(path, tests, services, files):
+    service_dir = os.path.join(path, "terraform-provider-aws", "internal", "service")
+    tests_per_file = math.ceil(tests / (services * files))
+    generated = 0
+    layout = {}
+    for service_index in range(services):
+        service = f"svc{service_index:03d}"
+        os.makedirs(os.path.join(service_dir, service))
+        for file_index in range(files):
+            names = []
+            while len(names) < tests_per_file and generated < tests:
+                names.append(f"Svc{service_index:03d}_test{generated:06d}")
+                generated += 1
+            if not names:
+                break
+            layout[service] = layout.get(service, 0) + len(names)
+            with open(
+                os.path.join(service_dir, service, f"res{file_index:03d}_test.go"), "w"
+            ) as file:
+                file.write(f'package {service}\n\nimport "testing"\n\n')
+                for name in names:
+                    file.write(f"func TestAcc{name}(t *testing.T) {{}}\n\n")
+    with open(os.path.join(path, "terraform-provider-aws", "go.mod"), "w") as file:
+        file.write("module github.com/hashicorp/terraform-provider-aws\n")
+    return layout
+
+
+def write_stub_go(bin_dir):
+    os.makedirs(bin_dir, exist_ok=True)
+    path = os.path.join(bin_dir, "go")
+    with open(path, "w") as file:
+        file.write(STUB_GO.format(python=sys.executable))
+    os.chmod(path, 0o755)
+
+
+class HealthHandler(http.server.BaseHTTPRequestHandler):
+    # stands in for LocalStack: every health probe gets an empty 200
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def start_health_server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), HealthHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def time_command(args, cwd, env):
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, GOAT_MAIN] + args,
+        cwd=cwd,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    stderr = process.stderr.read()
+    _, status, rusage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    return_code = os.waitstatus_to_exitcode(status)
+    if return_code != 0:
+        print(stderr.decode(errors="replace")[-2000:], file=sys.stderr)
+    return {
+        "seconds": round(seconds, 4),
+        "cpu_seconds": round(rusage.ru_utime + rusage.ru_stime, 4),
+        "max_rss_kb": rusage.ru_maxrss,
+        "return_code": return_code,
+    }
+
+
+def get_run_services(layout, run_tests):
+    services = []
+    selected = 0
+    for service, count in layout.items():
+        if services and selected + count > run_tests:
+            break
+        services.append(service)
+        selected += count
+    return services, selected
+
+
+def benchmark_size(work_dir, size, options, env):
+    path = os.path.join(work_dir, f"tests_{size}")
+    start = time.perf_counter()
+    layout = generate_tree(path, size, options.services, options.files)
+    print(
+        f"== {size} tests in {len(layout)} services ({time.perf_counter() - start:.2f}s to generate)",
+        file=sys.stderr,
+    )
+    run_services, run_count = get_run_services(layout, options.run_tests)
+    run_args = ["-s", ",".join(run_services), "-f", "--endpoints", options.endpoint]
+    first_service = next(iter(layout))
+    first_test = f"Svc{first_service[3:]}_test000000"
+    commands = [
+        ("scrape", ["scrape"]),
+        ("scrape-warm", ["scrape"]),
+        ("run", ["run"] + run_args),
+        ("run-batched", ["run", "-b", str(options.batch_size)] + run_args),
+        ("report", ["report"]),
+        ("print-summary", ["print-summary"]),
+        ("get-yaml", ["get-yaml", "-o", os.path.join(path, "out.yaml")]),
+    ]
+    # read-only commands are dominated by startup, so they take the median
+    # of several runs
+    startup_commands = [
+        ("help", ["--help"]),
+        ("list-services", ["list-services", "-a"]),
+        ("details", ["details", "-s", first_service, "-n", first_test]),
+        ("list", ["list", "-p", "test00001"]),
+        ("print-summary-service", ["print-summary", "-s", first_service]),
+    ]
+    results = []
+    for name, args in commands + startup_commands:
+        repeat = options.repeat if (name, args) in startup_commands else 1
+        runs = [time_command(args, path, env) for _ in range(repeat)]
+        result = sorted(runs, key=lambda run: run["seconds"])[len(runs) // 2]
+        result.update({"tests": size, "command": name, "repeat": repeat})
+        if name.startswith("run"):
+            result["tests_run"] = run_count
+        print(
+            f"{name:>14}: {result['seconds']:8.3f}s  {result['max_rss_kb'] / 1024:7.1f}MB  rc={result['return_code']}",
+            file=sys.stderr,
+        )
+        results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1000,10000,50000")
+    parser.add_argument("--services", type=int, default=100)
+    parser.add_argument("--files", type=int, default=10, help="Test files per service")
+    parser.add_argument(
+        "--run-tests",
+        type=int,
+        default=1000,
+        help="Upper bound of tests executed by the run commands",
+    )
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument(
+        "--test-seconds", type=float, default=0, help="Time the stub spends per test"
+    )
+    parser.add_argument(
+        "--output-lines", type=int, default=20, help="Lines the stub prints per test"
+    )
+    parser.add_argument(
+        "--fail-every", type=int, default=10, help="Fail one in this many tests"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Runs of each read-only command"
+    )
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated trees")
+    options = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="goat-benchmark-")
+    server = start_health_server()
+    options.endpoint = f"http://127.0.0.1:{server.server_address[1]}"
+    bin_dir = os.path.join(work_dir, "bin")
+    write_stub_go(bin_dir)
+    env = dict(os.environ)
+    env.update(
+        {
+            "PATH": bin_dir + os.pathsep + env.get("PATH", ""),
+            "GOAT_BENCH_TEST_SECONDS": str(options.test_seconds),
+            "GOAT_BENCH_OUTPUT_LINES": str(options.output_lines),
+            "GOAT_BENCH_FAIL_EVERY": str(options.fail_every),
+        }
+    )
+    results = []
+    try:
+        for size in (int(size) for size in options.sizes.split(",") if size):
+            results += benchmark_size(work_dir, size, options, env)
+    finally:
+        server.shutdown()
+        if options.keep:
+            print(f"Kept generated trees in {work_dir}", file=sys.stderr)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(options.output, "w") as file:
+        json.dump(
+            {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "options": {
+                    key: value
+                    for key, value in vars(options).items()
+                    if key != "endpoint"
+                },
+                "results": results,
+            },
+            file,
+            indent=2,
+        )
+    print(f"Wrote {len(results)} results to {options.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,641 @@
+import os
+import pickle
+import re
+import sqlite3
+import threading
+import time
+from constants import (
+    DURATION_HISTORY_SIZE,
+    PICKLE_TEST_DETAILS_FILE,
+    QUARANTINE_THRESHOLD,
+    QUARANTINE_WINDOW,
+    RESULT_STORE_FILE,
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tests (
+    test_id TEXT PRIMARY KEY,
+    service_name TEXT NOT NULL,
+    test_name TEXT NOT NULL,
+    return_code INTEGER,
+    start_time REAL,
+    end_time REAL,
+    process_start_time REAL,
+    process_end_time REAL,
+    completed INTEGER NOT NULL DEFAULT 0,
+    cpu_user REAL,
+    cpu_system REAL,
+    max_rss_kb INTEGER,
+    compile_time REAL,
+    test_file TEXT
+);
+CREATE INDEX IF NOT EXISTS tests_service_name ON tests (service_name, test_name);
+CREATE INDEX IF NOT EXISTS tests_test_name ON tests (test_name);
+CREATE TABLE IF NOT EXISTS test_trigrams (
+    trigram TEXT NOT NULL,
+    test_id TEXT NOT NULL,
+    PRIMARY KEY (trigram, test_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS test_trigrams_test_id ON test_trigrams (test_id);
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    services TEXT,
+    start_time REAL,
+    end_time REAL,
+    provider_ref TEXT
+);
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id INTEGER REFERENCES runs (run_id),
+    test_id TEXT NOT NULL,
+    return_code INTEGER,
+    start_time REAL,
+    end_time REAL,
+    process_start_time REAL,
+    process_end_time REAL,
+    cpu_user REAL,
+    cpu_system REAL,
+    max_rss_kb INTEGER,
+    compile_time REAL,
+    worker TEXT,
+    attempt INTEGER
+);
+CREATE INDEX IF NOT EXISTS history_test_id ON history (test_id, id);
+CREATE TABLE IF NOT EXISTS batches (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id INTEGER REFERENCES runs (run_id),
+    service_name TEXT NOT NULL,
+    worker TEXT,
+    tests INTEGER,
+    process_start_time REAL,
+    process_end_time REAL,
+    compile_time REAL,
+    cpu_user REAL,
+    cpu_system REAL,
+    max_rss_kb INTEGER
+);
+CREATE INDEX IF NOT EXISTS batches_run_id ON batches (run_id);
+"""
+
+TEST_COLUMNS = (
+    "test_id",
+    "service_name",
+    "test_name",
+    "return_code",
+    "start_time",
+    "end_time",
+    "process_start_time",
+    "process_end_time",
+    "completed",
+    "cpu_user",
+    "cpu_system",
+    "max_rss_kb",
+    "compile_time",
+)
+HISTORY_COLUMNS = (
+    "test_id",
+    "return_code",
+    "start_time",
+    "end_time",
+    "process_start_time",
+    "process_end_time",
+    "cpu_user",
+    "cpu_system",
+    "max_rss_kb",
+    "compile_time",
+    "worker",
+    "attempt",
+)
+RUN_COLUMNS = ("services", "start_time", "end_time", "provider_ref")
+# resource usage of a batch process covers all of its tests, so it is kept
+# once per batch while its tests have none of their own
+BATCH_COLUMNS = (
+    "service_name",
+    "worker",
+    "tests",
+    "process_start_time",
+    "process_end_time",
+    "compile_time",
+    "cpu_user",
+    "cpu_system",
+    "max_rss_kb",
+)
+USAGE_COLUMNS = ("process_end_time", "cpu_user", "cpu_system", "max_rss_kb")
+# bumped whenever SCHEMA or MIGRATIONS change; stores at this version are
+# opened without re-running the schema, migrations or search index backfill
+SCHEMA_VERSION = 3
+# rows fetched at a time by iterators over the shared connection
+FETCH_SIZE = 1000
+# columns added after the first release, created on stores that lack them
+# (indexes over them are created once they exist)
+MIGRATIONS = {
+    "tests": {
+        "cpu_user": "REAL",
+        "cpu_system": "REAL",
+        "max_rss_kb": "INTEGER",
+        "compile_time": "REAL",
+        "test_file": "TEXT",
+    },
+    "runs": {
+        "provider_ref": "TEXT",
+    },
+    "history": {
+        "process_start_time": "REAL",
+        "process_end_time": "REAL",
+        "cpu_user": "REAL",
+        "cpu_system": "REAL",
+        "max_rss_kb": "INTEGER",
+        "compile_time": "REAL",
+        "worker": "TEXT",
+        "attempt": "INTEGER",
+    },
+}
+
+
+def get_trigrams(text):
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+def regexp(pattern, value):
+    return re.search(pattern, value) is not None
+
+
+class ResultStore:
+    """SQLite (WAL mode) store holding one row per test plus a run history.
+
+    Results are committed as soon as a test finishes, so a killed runner
+    keeps everything that completed before it died.
+    """
+
+    def __init__(self, path=RESULT_STORE_FILE, pickle_file=PICKLE_TEST_DETAILS_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version < SCHEMA_VERSION:
+            self.connection.executescript(SCHEMA)
+            self.migrate()
+            # tests of stores from before the search index
+            self.build_search_index()
+            self.connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.connection.create_function("REGEXP", 2, regexp, deterministic=True)
+        self.run_id = None
+        if self.is_empty() and os.path.exists(pickle_file):
+            self.import_pickle(pickle_file)
+
+    def close(self):
+        self.connection.close()
+
+    def migrate(self):
+        with self.connection:
+            for table, columns in MIGRATIONS.items():
+                existing = self.get_columns(table)
+                for column, column_type in columns.items():
+                    if column not in existing:
+                        self.connection.execute(
+                            f"ALTER TABLE {table} ADD COLUMN {column} {column_type}"
+                        )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS tests_test_file ON tests (test_file)"
+            )
+
+    def is_empty(self):
+        return self.connection.execute("SELECT 1 FROM tests LIMIT 1").fetchone() is None
+
+    def import_pickle(self, pickle_file):
+        with open(pickle_file, "rb") as file:
+            test_details = pickle.load(file)
+        with self.lock, self.connection:
+            for test_detail in test_details.values():
+                self.upsert_test(test_detail)
+                if test_detail.completed:
+                    self.connection.execute(
+                        "INSERT INTO history (test_id, return_code, start_time, end_time) VALUES (?, ?, ?, ?)",
+                        (
+                            test_detail.test_id,
+                            test_detail.return_code,
+                            test_detail.start_time,
+                            test_detail.end_time,
+                        ),
+                    )
+        self.build_search_index()
+        print(f"Imported {len(test_details)} tests from {pickle_file}.")
+
+    def upsert_test(self, test_detail):
+        values = [getattr(test_detail, column, None) for column in TEST_COLUMNS]
+        placeholders = ", ".join("?" for _ in TEST_COLUMNS)
+        updates = ", ".join(
+            f"{column} = excluded.{column}" for column in TEST_COLUMNS[1:]
+        )
+        self.connection.execute(
+            f"INSERT INTO tests ({', '.join(TEST_COLUMNS)}) VALUES ({placeholders}) "
+            f"ON CONFLICT (test_id) DO UPDATE SET {updates}",
+            values,
+        )
+
+    def sync_tests(self, tests):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS scraped (test_id TEXT PRIMARY KEY)"
+            )
+            self.connection.execute("DELETE FROM scraped")
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO scraped (test_id) VALUES (?)",
+                ((test_id,) for test_id, _, _, _ in tests),
+            )
+            self.connection.executemany(
+                """INSERT INTO tests (test_id, service_name, test_name, test_file)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (test_id) DO UPDATE SET test_file = excluded.test_file""",
+                tests,
+            )
+            self.connection.execute(
+                "DELETE FROM tests WHERE test_id NOT IN (SELECT test_id FROM scraped)"
+            )
+            self.connection.execute(
+                "DELETE FROM test_trigrams WHERE test_id NOT IN (SELECT test_id FROM scraped)"
+            )
+        self.build_search_index()
+
+    def build_search_index(self):
+        with self.lock, self.connection:
+            rows = self.connection.execute(
+                """SELECT test_id, test_name FROM tests WHERE NOT EXISTS (
+                    SELECT 1 FROM test_trigrams WHERE test_trigrams.test_id = tests.test_id
+                )"""
+            ).fetchall()
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO test_trigrams (trigram, test_id) VALUES (?, ?)",
+                (
+                    (trigram, row["test_id"])
+                    for row in rows
+                    for trigram in get_trigrams(row["test_name"])
+                ),
+            )
+
+    def search_tests(self, query, mode="substring", service_name=None):
+        where = []
+        parameters = []
+        if mode == "prefix" and query:
+            # range scan on the test_name index
+            where.append("test_name >= ? AND test_name < ?")
+            parameters += [query, query[:-1] + chr(ord(query[-1]) + 1)]
+        elif mode == "regex":
+            # an invalid pattern would otherwise fail inside the REGEXP
+            # function as an sqlite3.OperationalError
+            try:
+                re.compile(query or "")
+            except re.error as e:
+                raise ValueError(f"Invalid pattern {query}: {e}")
+            where.append("test_name REGEXP ?")
+            parameters.append(query or "")
+        elif mode == "substring" and query:
+            trigrams = sorted(get_trigrams(query))
+            if trigrams:
+                where.append(f"""test_id IN (
+                        SELECT test_id FROM test_trigrams
+                        WHERE trigram IN ({', '.join('?' for _ in trigrams)})
+                        GROUP BY test_id HAVING COUNT(*) = ?
+                    )""")
+                parameters += trigrams + [len(trigrams)]
+            where.append("instr(test_name, ?) > 0")
+            parameters.append(query)
+        if service_name:
+            where.append("service_name = ?")
+            parameters.append(service_name)
+        return self.query(
+            f"SELECT * FROM tests WHERE {' AND '.join(where) or '1'} ORDER BY rowid",
+            parameters,
+        )
+
+    def start_run(self, services, provider_ref=None):
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO runs (services, start_time, provider_ref) VALUES (?, ?, ?)",
+                (",".join(services), time.time(), provider_ref),
+            )
+        self.run_id = cursor.lastrowid
+        return self.run_id
+
+    def finish_run(self):
+        if self.run_id is None:
+            return
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE runs SET end_time = ? WHERE run_id = ?",
+                (time.time(), self.run_id),
+            )
+
+    def record(self, test_detail):
+        with self.lock, self.connection:
+            self.upsert_test(test_detail)
+            values = [getattr(test_detail, column, None) for column in HISTORY_COLUMNS]
+            self.connection.execute(
+                f"INSERT INTO history (run_id, {', '.join(HISTORY_COLUMNS)}) "
+                f"VALUES (?, {', '.join('?' for _ in HISTORY_COLUMNS)})",
+                [self.run_id] + values,
+            )
+
+    def update_usage(self, test_details):
+        """Stores resource usage that only became known after the tests
+        were recorded, i.e. once the batch process running them exited."""
+        updates = ", ".join(f"{column} = ?" for column in USAGE_COLUMNS)
+        with self.lock, self.connection:
+            for test_detail in test_details:
+                values = [getattr(test_detail, column) for column in USAGE_COLUMNS]
+                self.connection.execute(
+                    f"UPDATE tests SET {updates} WHERE test_id = ?",
+                    values + [test_detail.test_id],
+                )
+                self.connection.execute(
+                    f"""UPDATE history SET {updates} WHERE id = (
+                        SELECT MAX(id) FROM history WHERE test_id = ? AND run_id IS ?
+                    )""",
+                    values + [test_detail.test_id, self.run_id],
+                )
+
+    def record_batch(self, batch):
+        """Stores a finished batch process and its resource usage."""
+        with self.lock, self.connection:
+            self.connection.execute(
+                f"INSERT INTO batches (run_id, {', '.join(BATCH_COLUMNS)}) "
+                f"VALUES (?, {', '.join('?' for _ in BATCH_COLUMNS)})",
+                [self.run_id] + [batch[column] for column in BATCH_COLUMNS],
+            )
+
+    def get_columns(self, table, schema="main"):
+        return [
+            row["name"]
+            for row in self.connection.execute(f"PRAGMA {schema}.table_info({table})")
+        ]
+
+    def merge_from(self, path):
+        """Merges another store into this one in a single pass of SQL.
+
+        A test's row is replaced when the other store completed it later;
+        runs and history are appended unless already present. Yields the
+        (service_name, test_name) of every test taken from the other store.
+        """
+        with self.lock:
+            self.connection.execute("ATTACH DATABASE ? AS source", (path,))
+        try:
+            with self.lock, self.connection:
+                columns = [
+                    column
+                    for column in self.get_columns("tests")
+                    if column in self.get_columns("tests", "source")
+                ]
+                updates = ", ".join(
+                    f"{column} = excluded.{column}" for column in columns[1:]
+                )
+                self.connection.execute("DROP TABLE IF EXISTS temp.merged")
+                self.connection.execute("""CREATE TEMP TABLE merged AS
+                    SELECT source_tests.service_name, source_tests.test_name
+                    FROM source.tests AS source_tests
+                    LEFT JOIN tests USING (test_id)
+                    WHERE source_tests.completed AND (
+                        tests.test_id IS NULL OR NOT tests.completed
+                        OR source_tests.end_time > tests.end_time
+                    )""")
+                self.connection.execute(f"""INSERT INTO tests ({', '.join(columns)})
+                    SELECT {', '.join(columns)} FROM source.tests WHERE true
+                    ON CONFLICT (test_id) DO UPDATE SET {updates}
+                    WHERE excluded.completed AND (
+                        NOT tests.completed OR excluded.end_time > tests.end_time
+                    )""")
+                run_columns = ", ".join(
+                    column
+                    for column in RUN_COLUMNS
+                    if column in self.get_columns("runs", "source")
+                )
+                self.connection.execute(f"""INSERT INTO runs ({run_columns})
+                    SELECT {run_columns} FROM source.runs AS source_runs
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM runs WHERE runs.start_time IS source_runs.start_time
+                        AND runs.services IS source_runs.services
+                    ) ORDER BY run_id""")
+                history_columns = [
+                    column
+                    for column in HISTORY_COLUMNS
+                    if column in self.get_columns("history", "source")
+                ]
+                source_columns = ", ".join(
+                    f"source_history.{column}" for column in history_columns
+                )
+                self.connection.execute(
+                    f"""INSERT INTO history (run_id, {', '.join(history_columns)})
+                    SELECT runs.run_id, {source_columns}
+                    FROM source.history AS source_history
+                    LEFT JOIN source.runs AS source_runs USING (run_id)
+                    LEFT JOIN runs ON runs.start_time IS source_runs.start_time
+                        AND runs.services IS source_runs.services
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM history
+                        WHERE history.test_id = source_history.test_id
+                        AND history.start_time IS source_history.start_time
+                    ) ORDER BY source_history.id"""
+                )
+                # stores from before batches were recorded have no such table
+                batch_columns = [
+                    column
+                    for column in BATCH_COLUMNS
+                    if column in self.get_columns("batches", "source")
+                ]
+                if batch_columns:
+                    source_columns = ", ".join(
+                        f"source_batches.{column}" for column in batch_columns
+                    )
+                    self.connection.execute(
+                        f"""INSERT INTO batches (run_id, {', '.join(batch_columns)})
+                        SELECT runs.run_id, {source_columns}
+                        FROM source.batches AS source_batches
+                        LEFT JOIN source.runs AS source_runs USING (run_id)
+                        LEFT JOIN runs ON runs.start_time IS source_runs.start_time
+                            AND runs.services IS source_runs.services
+                        WHERE NOT EXISTS (
+                            SELECT 1 FROM batches
+                            WHERE batches.worker IS source_batches.worker
+                            AND batches.process_start_time IS source_batches.process_start_time
+                        ) ORDER BY source_batches.id"""
+                    )
+            cursor = self.connection.execute("SELECT * FROM temp.merged")
+            for row in cursor:
+                yield row["service_name"], row["test_name"]
+        finally:
+            with self.lock:
+                self.connection.execute("DROP TABLE IF EXISTS temp.merged")
+                self.connection.execute("DETACH DATABASE source")
+        self.build_search_index()
+
+    def query(self, sql, parameters=()):
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def iter_query(self, sql, parameters=()):
+        # the connection is shared with worker threads, so rows are fetched
+        # under the lock a chunk at a time
+        with self.lock:
+            cursor = self.connection.execute(sql, parameters)
+        while True:
+            with self.lock:
+                rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                return
+            yield from rows
+
+    def iter_tests(self, where="1", parameters=(), order="rowid"):
+        return self.iter_query(
+            f"SELECT * FROM tests WHERE {where} ORDER BY {order}", parameters
+        )
+
+    def iter_tests_with_durations(self, size, order="rowid"):
+        """Yields every test's row with the durations of its last `size`
+        passed attempts, oldest first, looked up per test through the
+        history index while streaming."""
+        rows = self.iter_query(
+            f"""SELECT tests.*, (
+                SELECT group_concat(id || ':' || duration) FROM (
+                    SELECT id, end_time - start_time AS duration FROM history
+                    WHERE history.test_id = tests.test_id
+                        AND return_code = 0 AND end_time IS NOT NULL
+                    ORDER BY id DESC LIMIT ?
+                )
+            ) AS durations
+            FROM tests ORDER BY {order}""",
+            (size,),
+        )
+        for row in rows:
+            # group_concat does not keep the order of its input
+            attempts = sorted(
+                (int(attempt_id), float(duration))
+                for attempt_id, duration in (
+                    attempt.split(":")
+                    for attempt in (row["durations"] or "").split(",")
+                    if attempt
+                )
+            )
+            yield row, [duration for _, duration in attempts]
+
+    def get_last_run_id(self):
+        rows = self.query("SELECT MAX(run_id) AS run_id FROM runs")
+        return rows[0]["run_id"]
+
+    def get_run_history(self, run_id):
+        return self.query(
+            """SELECT history.*, tests.service_name, tests.test_name
+            FROM history JOIN tests USING (test_id)
+            WHERE run_id = ? AND history.end_time IS NOT NULL
+            ORDER BY history.start_time""",
+            (run_id,),
+        )
+
+    def get_run_batches(self, run_id):
+        return self.query(
+            "SELECT * FROM batches WHERE run_id = ? ORDER BY id", (run_id,)
+        )
+
+    def get_runs(self):
+        return self.query("SELECT * FROM runs ORDER BY run_id")
+
+    def get_duration_history(self, run_ids, service_name=None):
+        """Returns the durations of passed tests in the given runs, oldest
+        first; failed attempts end early or time out, so they are left out."""
+        where = [f"history.run_id IN ({', '.join('?' for _ in run_ids)})"]
+        parameters = list(run_ids)
+        if service_name:
+            where.append("tests.service_name = ?")
+            parameters.append(service_name)
+        return self.query(
+            f"""SELECT history.run_id, history.test_id, tests.service_name, tests.test_name,
+                history.end_time - history.start_time AS duration
+            FROM history JOIN tests USING (test_id)
+            WHERE {' AND '.join(where)}
+                AND history.return_code = 0 AND history.end_time IS NOT NULL
+            ORDER BY history.id""",
+            parameters,
+        )
+
+    def get_flaky_tests(self, window=QUARANTINE_WINDOW, threshold=QUARANTINE_THRESHOLD):
+        """Returns {test_id: flaky run count} of tests that failed and then
+        passed within the same run in at least `threshold` of the last
+        `window` runs."""
+        rows = self.query(
+            """SELECT test_id, COUNT(*) AS flaky_runs FROM (
+                SELECT test_id FROM history
+                WHERE run_id IN (SELECT run_id FROM runs ORDER BY run_id DESC LIMIT ?)
+                GROUP BY test_id, run_id
+                HAVING MIN(return_code) = 0 AND MAX(return_code) != 0
+            ) GROUP BY test_id HAVING COUNT(*) >= ?""",
+            (window, threshold),
+        )
+        return {row["test_id"]: row["flaky_runs"] for row in rows}
+
+    def get_test_files(self, paths):
+        paths = list(paths)
+        rows = self.query(
+            f"SELECT DISTINCT test_file FROM tests WHERE test_file IN ({', '.join('?' for _ in paths)})",
+            paths,
+        )
+        return {row["test_file"] for row in rows}
+
+    def get_test(self, service_name, test_name):
+        rows = self.query(
+            "SELECT * FROM tests WHERE service_name = ? AND test_name = ?",
+            (service_name, test_name),
+        )
+        return rows[0] if rows else None
+
+    def get_services(self):
+        return [
+            row["service_name"]
+            for row in self.query(
+                "SELECT DISTINCT service_name FROM tests ORDER BY service_name"
+            )
+        ]
+
+    def get_summary(self, service_name=None):
+        where = "WHERE service_name = ?" if service_name else ""
+        return self.query(
+            f"""SELECT service_name,
+                COUNT(*) AS total,
+                SUM(completed) AS completed,
+                SUM(completed AND return_code = 0) AS passed,
+                SUM(completed AND return_code != 0) AS failed
+            FROM tests {where} GROUP BY service_name ORDER BY MIN(rowid)""",
+            (service_name,) if service_name else (),
+        )
+
+    def get_durations(self, test_ids, size=DURATION_HISTORY_SIZE, passed=False):
+        """Returns {test_id: durations} of the last `size` attempts, oldest
+        first, of the given tests (or of every test when None)."""
+        where = "end_time IS NOT NULL"
+        if passed:
+            where += " AND return_code = 0"
+        with self.lock, self.connection:
+            if test_ids is not None:
+                # too many ids for bound parameters, the temp table is joined
+                # through the history index instead
+                self.connection.execute(
+                    "CREATE TEMP TABLE IF NOT EXISTS selected (test_id TEXT PRIMARY KEY)"
+                )
+                self.connection.execute("DELETE FROM selected")
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO selected (test_id) VALUES (?)",
+                    ((test_id,) for test_id in test_ids),
+                )
+                where += " AND test_id IN (SELECT test_id FROM selected)"
+            rows = self.connection.execute(
+                f"""SELECT test_id, duration FROM (
+                    SELECT test_id, id, end_time - start_time AS duration,
+                        ROW_NUMBER() OVER (PARTITION BY test_id ORDER BY id DESC) AS position
+                    FROM history WHERE {where}
+                ) WHERE position <= ? ORDER BY id""",
+                (size,),
+            ).fetchall()
+        durations = {}
+        for row in rows:
+            durations.setdefault(row["test_id"], []).append(row["duration"])
+        return durations
@@ -0,0 +1,166 @@
+import itertools
+import json
+from colorama import Fore
+from constants import TRACE_FILE
+from scheduler import format_duration
+
+USAGE_ARGS = ("cpu_user", "cpu_system", "max_rss_kb")
+
+
+def to_microseconds(seconds):
+    return round(seconds * 1000000)
+
+
+def get_process_span(row):
+    # rows recorded before process times were tracked fall back to the test
+    return (
+        row["process_start_time"] or row["start_time"],
+        row["process_end_time"] or row["end_time"],
+    )
+
+
+def get_process_key(row):
+    return row["worker"] or "unknown", get_process_span(row)[0]
+
+
+class Timeline:
+    """Builds a Chrome trace (also readable by Perfetto) of one run.
+
+    Every scheduler worker gets a track showing the `go test` processes it
+    ran, with compile time as a nested slice. Tests that ran concurrently
+    inside one batch process are spread over extra tracks of the worker,
+    while the usage of the process is shown on the batch slice.
+    """
+
+    def __init__(self, rows, batches=()):
+        self.rows = rows
+        self.batches = {
+            (batch["worker"] or "unknown", batch["process_start_time"]): batch
+            for batch in batches
+        }
+        self.origin = min(get_process_span(row)[0] for row in rows) if rows else 0
+        self.events = []
+        self.tracks = {}
+
+    def get_track(self, name):
+        if name not in self.tracks:
+            self.tracks[name] = len(self.tracks) + 1
+            self.events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": 1,
+                    "tid": self.tracks[name],
+                    "args": {"name": name},
+                }
+            )
+        return self.tracks[name]
+
+    def add_slice(self, track, name, start, end, category, args=None):
+        self.events.append(
+            {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "pid": 1,
+                "tid": self.get_track(track),
+                "ts": to_microseconds(start - self.origin),
+                "dur": to_microseconds(end - start),
+                "args": args or {},
+            }
+        )
+
+    def get_usage(self, row):
+        return {column: row[column] for column in USAGE_ARGS if row[column] is not None}
+
+    def add_process(self, worker, rows):
+        first = rows[0]
+        start = get_process_span(first)[0]
+        end = max(get_process_span(row)[1] for row in rows)
+        if len(rows) > 1 or first["compile_time"]:
+            name = f"go test {first['service_name']} ({len(rows)} tests)"
+            # runs from before batches were recorded copied it onto every test
+            batch = self.batches.get(get_process_key(first), first)
+            self.add_slice(worker, name, start, end, "process", self.get_usage(batch))
+        if first["compile_time"]:
+            self.add_slice(
+                worker,
+                "compile",
+                start,
+                start + first["compile_time"],
+                "compile",
+            )
+        lanes = []
+        for row in sorted(rows, key=lambda row: row["start_time"]):
+            lane = next(
+                (
+                    index
+                    for index, lane_end in enumerate(lanes)
+                    if lane_end <= row["start_time"]
+                ),
+                len(lanes),
+            )
+            if lane == len(lanes):
+                lanes.append(row["end_time"])
+            else:
+                lanes[lane] = row["end_time"]
+            track = f"{worker} #{lane + 1}" if len(rows) > 1 else worker
+            args = {"service": row["service_name"], "return_code": row["return_code"]}
+            if len(rows) == 1:
+                args.update(self.get_usage(row))
+            self.add_slice(
+                track,
+                row["test_name"],
+                row["start_time"],
+                row["end_time"],
+                "test",
+                args,
+            )
+
+    def build(self):
+        self.events.append(
+            {"name": "process_name", "ph": "M", "pid": 1, "args": {"name": "goat"}}
+        )
+        for (worker, _), rows in itertools.groupby(
+            sorted(self.rows, key=get_process_key), key=get_process_key
+        ):
+            self.add_process(worker, list(rows))
+        return {"traceEvents": self.events, "displayTimeUnit": "ms"}
+
+    @property
+    def makespan(self):
+        if not self.rows:
+            return 0
+        return max(get_process_span(row)[1] for row in self.rows) - self.origin
+
+    def get_utilization(self):
+        # a batch process is counted once however many tests it ran
+        processes = {}
+        for row in self.rows:
+            start, end = get_process_span(row)
+            processes[get_process_key(row)] = max(
+                processes.get(get_process_key(row), 0), end - start
+            )
+        busy = {}
+        for (worker, _), duration in processes.items():
+            if worker == "unknown":
+                # recorded before workers were tracked
+                continue
+            busy[worker] = busy.get(worker, 0) + duration
+        return {
+            worker: duration / self.makespan if self.makespan else 0
+            for worker, duration in sorted(busy.items())
+        }
+
+
+def export_trace(store, run_id=None, output_file=TRACE_FILE):
+    run_id = run_id or store.get_last_run_id()
+    rows = store.get_run_history(run_id)
+    timeline = Timeline(rows, store.get_run_batches(run_id))
+    with open(output_file, "w") as file:
+        json.dump(timeline.build(), file)
+    print(f"Exported {len(rows)} tests of run {run_id} to {output_file}")
+    print(f"Makespan: {format_duration(timeline.makespan)}")
+    for worker, utilization in timeline.get_utilization().items():
+        color = Fore.GREEN if utilization >= 0.8 else Fore.YELLOW
+        print(f"{color}{worker}: {utilization:.0%} busy")
@@ -0,0 +1,342 @@
+import collections
+import math
+import statistics
+from colorama import Fore
+from constants import (
+    SPARKLINE_SIZE,
+    TREND_ALPHA,
+    TREND_MIN_RATIO,
+    TREND_MIN_SAMPLES,
+    TREND_OUTLIER_SCORE,
+    TREND_WINDOW,
+)
+from impact import get_revision
+from utils import format_seconds, get_percentile
+
+SPARKS = "▁▂▃▄▅▆▇█"
+NORMAL = statistics.NormalDist()
+# rank tests switch from exact null distributions to the normal approximation
+# above this many samples
+EXACT_MAX_SIZE = 20
+
+
+def sparkline(values):
+    if not values:
+        return ""
+    low, high = min(values), max(values)
+    if high == low:
+        return SPARKS[0] * len(values)
+    return "".join(
+        SPARKS[round((value - low) / (high - low) * (len(SPARKS) - 1))]
+        for value in values
+    )
+
+
+def get_ranks(values):
+    # 1-based ranks, ties share the average of their ranks
+    order = sorted(range(len(values)), key=values.__getitem__)
+    ranks = [0] * len(values)
+    start = 0
+    while start < len(order):
+        end = start
+        while end + 1 < len(order) and values[order[end + 1]] == values[order[start]]:
+            end += 1
+        for position in range(start, end + 1):
+            ranks[order[position]] = (start + end) / 2 + 1
+        start = end + 1
+    return ranks
+
+
+def get_tie_correction(values):
+    return sum(count**3 - count for count in collections.Counter(values).values())
+
+
+def get_rank_sum_counts(ranks, size=None):
+    # exact null distribution of the sum of `size` of the ranks (of every
+    # signed subset when None), as counts by doubled sum since tied ranks
+    # are halves
+    if size is None:
+        counts = {0: 1}
+        for rank in ranks:
+            shifted = collections.Counter(counts)
+            for total, count in counts.items():
+                shifted[total + int(rank * 2)] += count
+            counts = shifted
+        return counts
+    counts = [collections.Counter({0: 1})] + [
+        collections.Counter() for _ in range(size)
+    ]
+    for rank in ranks:
+        for taken in range(size, 0, -1):
+            for total, count in counts[taken - 1].items():
+                counts[taken][total + int(rank * 2)] += count
+    return counts[size]
+
+
+def get_upper_tail(counts, statistic):
+    # share of the distribution at or above the observed doubled statistic
+    observed = round(statistic * 2)
+    return sum(count for total, count in counts.items() if total >= observed) / sum(
+        counts.values()
+    )
+
+
+def mann_whitney(base, head):
+    """One-sided p-value of `head` durations being larger than `base` ones
+    (Mann-Whitney U, exact up to EXACT_MAX_SIZE durations, then normal
+    approximation with tie and continuity correction)."""
+    base_size, head_size = len(base), len(head)
+    size = base_size + head_size
+    ranks = get_ranks(base + head)
+    if size <= EXACT_MAX_SIZE:
+        counts = get_rank_sum_counts(ranks, head_size)
+        return get_upper_tail(counts, sum(ranks[base_size:]))
+    u = sum(ranks[base_size:]) - head_size * (head_size + 1) / 2
+    variance = (
+        base_size
+        * head_size
+        / 12
+        * (size + 1 - get_tie_correction(base + head) / (size * (size - 1)))
+    )
+    if variance <= 0:
+        return 1.0
+    z = (u - base_size * head_size / 2 - 0.5) / math.sqrt(variance)
+    return 1 - NORMAL.cdf(z)
+
+
+def wilcoxon(differences):
+    """One-sided p-value of paired differences being above zero (Wilcoxon
+    signed-rank, exact up to EXACT_MAX_SIZE differences, then normal
+    approximation with tie and continuity correction)."""
+    differences = [difference for difference in differences if difference != 0]
+    size = len(differences)
+    if not size:
+        return 1.0
+    magnitudes = [abs(difference) for difference in differences]
+    ranks = get_ranks(magnitudes)
+    w = sum(rank for rank, difference in zip(ranks, differences) if difference > 0)
+    if size <= EXACT_MAX_SIZE:
+        return get_upper_tail(get_rank_sum_counts(ranks), w)
+    variance = (
+        size * (size + 1) * (2 * size + 1) / 24 - get_tie_correction(magnitudes) / 48
+    )
+    z = (w - size * (size + 1) / 4 - 0.5) / math.sqrt(variance)
+    return 1 - NORMAL.cdf(z)
+
+
+def get_outlier_score(value, values):
+    # modified z-score (Iglewicz and Hoaglin) of value against its history
+    median = statistics.median(values)
+    deviation = statistics.median(abs(other - median) for other in values)
+    if deviation == 0:
+        return math.inf if value > median else 0.0
+    return 0.6745 * (value - median) / deviation
+
+
+def resolve_runs(store, selector):
+    """Run ids of a run id or of every run of a provider revision."""
+    runs = store.get_runs()
+    run_ids = []
+    if str(selector).isdigit():
+        run_ids = [run["run_id"] for run in runs if run["run_id"] == int(selector)]
+    # an all-digit selector can also be an abbreviated revision
+    if not run_ids:
+        revision = get_revision(selector) or selector
+        run_ids = [
+            run["run_id"]
+            for run in runs
+            if run["provider_ref"] and run["provider_ref"].startswith(revision)
+        ]
+    if not run_ids:
+        raise Exception(f"No runs recorded for {selector}")
+    return run_ids
+
+
+def format_runs(run_ids):
+    if not run_ids:
+        return "none"
+    if len(run_ids) == 1:
+        return f"#{run_ids[0]}"
+    return f"#{min(run_ids)}-#{max(run_ids)}"
+
+
+class Trends:
+    """Duration trends of passed tests across runs, and their regressions.
+
+    Every test gets the median and P95 of its last `window` durations and
+    is compared between the base and head runs: with enough durations on
+    both sides for a significant result by a Mann-Whitney U test, otherwise
+    by the head median's outlier score against the base ones. Services
+    compare their tests' median durations pairwise with a Wilcoxon
+    signed-rank test, which also works between two single runs but needs
+    enough tests to reach `alpha`. Only slowdowns of at least `min_ratio`
+    are flagged.
+    """
+
+    def __init__(
+        self,
+        rows,
+        base_runs,
+        head_runs,
+        window=TREND_WINDOW,
+        alpha=TREND_ALPHA,
+        min_ratio=TREND_MIN_RATIO,
+    ):
+        self.base_runs = set(base_runs)
+        self.head_runs = set(head_runs)
+        self.window = window
+        self.alpha = alpha
+        self.min_ratio = min_ratio
+        self.tests = {}
+        self.services = {}
+        for row in rows:
+            test = self.tests.setdefault(
+                row["test_id"],
+                {
+                    "service": row["service_name"],
+                    "name": row["test_name"],
+                    "runs": {},
+                },
+            )
+            # the last passed attempt of a run counts
+            test["runs"][row["run_id"]] = row["duration"]
+        for test_id, test in self.tests.items():
+            self.services.setdefault(test["service"], []).append(test_id)
+
+    def get_durations(self, test_id, run_ids):
+        runs = self.tests[test_id]["runs"]
+        return [runs[run_id] for run_id in sorted(runs) if run_id in run_ids]
+
+    def get_history(self, test_id):
+        runs = self.tests[test_id]["runs"]
+        return [runs[run_id] for run_id in sorted(runs)]
+
+    def get_service_history(self, service):
+        durations = {}
+        for test_id in self.services[service]:
+            for run_id, duration in self.tests[test_id]["runs"].items():
+                durations.setdefault(run_id, []).append(duration)
+        return [statistics.median(durations[run_id]) for run_id in sorted(durations)]
+
+    def get_rolling(self, history):
+        recent = history[-self.window :]
+        return statistics.median(recent), get_percentile(recent, 95)
+
+    def compare_test(self, test_id):
+        base = self.get_durations(test_id, self.base_runs)
+        head = self.get_durations(test_id, self.head_runs)
+        if not base or not head:
+            return None
+        base_median, head_median = statistics.median(base), statistics.median(head)
+        ratio = head_median / base_median if base_median > 0 else math.inf
+        if ratio < self.min_ratio:
+            return None
+        # rank tests only run when their most extreme outcome could be
+        # significant, else a single outlier score is the better evidence
+        if (
+            len(base) >= 2
+            and len(head) >= 2
+            and 1 / math.comb(len(base) + len(head), len(head)) < self.alpha
+        ):
+            p_value = mann_whitney(base, head)
+            if p_value >= self.alpha:
+                return None
+            evidence = f"p={p_value:.3f}"
+        elif len(base) >= TREND_MIN_SAMPLES:
+            score = get_outlier_score(head_median, base)
+            if score <= TREND_OUTLIER_SCORE:
+                return None
+            evidence = f"score={score:.1f}"
+        else:
+            return None
+        return base_median, head_median, ratio, evidence
+
+    def compare_service(self, service):
+        differences = []
+        for test_id in self.services[service]:
+            base = self.get_durations(test_id, self.base_runs)
+            head = self.get_durations(test_id, self.head_runs)
+            if base and head and min(base + head) > 0:
+                differences.append(
+                    math.log(statistics.median(head) / statistics.median(base))
+                )
+        if (
+            len(differences) < TREND_MIN_SAMPLES
+            or 0.5 ** len(differences) >= self.alpha
+        ):
+            return None
+        ratio = math.exp(statistics.median(differences))
+        p_value = wilcoxon(differences)
+        if ratio < self.min_ratio or p_value >= self.alpha:
+            return None
+        return ratio, len(differences), p_value
+
+    def print_trends(self, show_all=False):
+        """Prints every service's trend and regressions, returning how many
+        tests and services got slower."""
+        slower = 0
+        for service in sorted(self.services):
+            history = self.get_service_history(service)
+            median, p95 = self.get_rolling(history)
+            print(f"-----{service}-----")
+            print(
+                f"Median: {format_seconds(median)} - P95: {format_seconds(p95)} - Trend: {sparkline(history[-SPARKLINE_SIZE:])}"
+            )
+            regression = self.compare_service(service)
+            if regression:
+                ratio, tests, p_value = regression
+                slower += 1
+                print(
+                    f"{Fore.RED}[SLOWER]  :: {service} - {ratio:.1f}x over {tests} tests (p={p_value:.3f})"
+                )
+            for test_id in sorted(
+                self.services[service], key=lambda test_id: self.tests[test_id]["name"]
+            ):
+                test = self.tests[test_id]
+                regression = self.compare_test(test_id)
+                if regression:
+                    base_median, head_median, ratio, evidence = regression
+                    slower += 1
+                    print(
+                        f"{Fore.RED}[SLOWER]  :: {test['name']} - {format_seconds(base_median)} -> {format_seconds(head_median)} ({ratio:.1f}x, {evidence})"
+                    )
+                elif show_all:
+                    history = self.get_history(test_id)
+                    median, p95 = self.get_rolling(history)
+                    print(
+                        f"[TREND]   :: {test['name']} - Median: {format_seconds(median)} - P95: {format_seconds(p95)} - {sparkline(history[-SPARKLINE_SIZE:])}"
+                    )
+        return slower
+
+
+def show_trends(
+    store,
+    base=None,
+    head=None,
+    service_name=None,
+    window=TREND_WINDOW,
+    alpha=TREND_ALPHA,
+    min_ratio=TREND_MIN_RATIO,
+    show_all=False,
+):
+    if store.get_last_run_id() is None:
+        print("No runs recorded yet.")
+        return 0
+    head_runs = resolve_runs(store, head) if head else [store.get_last_run_id()]
+    if base:
+        base_runs = resolve_runs(store, base)
+    else:
+        base_runs = [
+            run["run_id"] for run in store.get_runs() if run["run_id"] < min(head_runs)
+        ][-window:]
+    rows = store.get_duration_history(
+        sorted(set(base_runs) | set(head_runs)), service_name
+    )
+    print(
+        f"Comparing {format_runs(head_runs)} against {format_runs(base_runs)} ({len(base_runs)} run{'s' if len(base_runs) != 1 else ''}) over {len({row['test_id'] for row in rows})} tests"
+    )
+    trends = Trends(rows, base_runs, head_runs, window, alpha, min_ratio)
+    slower = trends.print_trends(show_all)
+    color = Fore.RED if slower else Fore.GREEN
+    print(f"{color}{slower} regressions found")
+    return slower
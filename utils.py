@@ -1,6 +1,10 @@
-from constants import GO_TEST_CMD, TEST_DIR, TEST_ARG_PARAMS, LOCALSTACK_ENDPOINT, HTTP_SERVER_HOST, HTTP_SERVER_PORT
-import requests
-import http.server
+from constants import GO_TEST_CMD, GO_TOOL_TEST2JSON_CMD, GO_TEST_PREFIX, TEST_DIR, TEST_ARG_PARAMS, LOCALSTACK_ENDPOINT, HEALTH_CHECK_TIMEOUT
+import math
+import os
+import re
+import signal
+import threading
+import time
 
 def get_str_from_dict(dict_obj):
     str_obj = ""
@@ -11,6 +15,27 @@ def get_str_from_dict(dict_obj):
             str_obj += f"{key}={dict_obj[key]} "
     return str_obj.strip(" ")
 
+def parse_service_caps(value):
+    caps = {}
+    for cap in value.split(","):
+        if not cap:
+            continue
+        if "=" in cap:
+            service_name, limit = cap.split("=", 1)
+        else:
+            service_name, limit = None, cap
+        # a cap below 1 would never let the service's tests start
+        if int(limit) < 1:
+            raise ValueError(f"cap {cap} is below 1")
+        caps[service_name] = int(limit)
+    return caps
+
+def parse_shard(value):
+    index, count = (int(part) for part in value.split("/"))
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError(f"shard {value} is out of range")
+    return index, count
+
 def get_test_id(service_name, test_name):
     return f"{service_name}_{test_name}"
 
@@ -18,9 +43,95 @@ def get_test_run_command(service_name, test_name):
     command = f"{GO_TEST_CMD} {TEST_DIR}/{service_name}/ {get_str_from_dict(TEST_ARG_PARAMS)} -run {test_name}"
     return command.split(" ")
 
-def check_health_status():
+def parse_go_duration(value):
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(h|ms|m|s)", value)
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+def get_batch_arg_params(test_count, parallel):
+    # `-timeout` bounds the whole `go test` process, so a batch gets the
+    # per-test timeout once for every round of `parallel` tests it runs
+    params = dict(TEST_ARG_PARAMS)
+    timeout = parse_go_duration(params.get("-timeout", ""))
+    if timeout > 0:
+        rounds = math.ceil(test_count / max(parallel, 1))
+        params["-timeout"] = f"{timeout * rounds:.0f}s"
+    return params
+
+def get_batch_run_command(service_name, test_names, parallel):
+    run_pattern = f"^{GO_TEST_PREFIX}({'|'.join(test_names)})$"
+    arg_params = get_batch_arg_params(len(test_names), parallel)
+    command = f"{GO_TEST_CMD} {TEST_DIR}/{service_name}/ -json {get_str_from_dict(arg_params)} -parallel {parallel} -run {run_pattern}"
+    return command.split(" ")
+
+def get_warmup_command(service_name):
+    # compiles the test package and runs no test
+    command = f"{GO_TEST_CMD} {TEST_DIR}/{service_name}/ -count=1 -run ^$"
+    return command.split(" ")
+
+def get_test_binary_args(arg_params=TEST_ARG_PARAMS):
+    return {f"-test.{key.lstrip('-')}": value for key, value in arg_params.items()}
+
+def get_binary_run_command(binary, test_name):
+    return [binary] + get_str_from_dict(get_test_binary_args()).split(" ") + ["-test.run", test_name]
+
+def get_batch_binary_run_command(binary, service_name, test_names, parallel):
+    run_pattern = f"^{GO_TEST_PREFIX}({'|'.join(test_names)})$"
+    binary_args = get_test_binary_args(get_batch_arg_params(len(test_names), parallel))
+    binary_args["-test.v"] = "test2json"
+    test2json = f"{GO_TOOL_TEST2JSON_CMD} {TEST_DIR}/{service_name}/"
+    args = f"{get_str_from_dict(binary_args)} -test.parallel {parallel} -test.run {run_pattern}"
+    return test2json.split(" ") + [binary] + args.split(" ")
+
+def parse_endpoints(value):
+    return [endpoint.rstrip("/") for endpoint in value.split(",") if endpoint]
+
+def wait_process(process):
+    """Waits for a child process and returns its resource usage, which
+    includes the processes it waited for itself (e.g. the compiler)."""
     try:
-        response = requests.get(LOCALSTACK_ENDPOINT)
+        _, status, rusage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        # already reaped, e.g. by a kill() on termination
+        process.wait()
+        return None
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return rusage
+
+def kill_process_tree(process):
+    # processes are started in their own session, so the group id is the pid
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+def start_kill_timer(process, timeout):
+    def expire():
+        timer.expired = True
+        kill_process_tree(process)
+
+    timer = threading.Timer(timeout, expire)
+    timer.expired = False
+    timer.daemon = True
+    timer.start()
+    return timer
+
+def get_percentile(values, percentile):
+    values = sorted(values)
+    rank = math.ceil(percentile / 100 * len(values))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+def format_seconds(seconds):
+    return f"{int(seconds // 60):02d}m {seconds % 60:06.3f}s"
+
+def check_health_status(endpoint=LOCALSTACK_ENDPOINT, session=None):
+    if session is None:
+        # requests takes longer to import than most commands take to run
+        import requests
+
+        session = requests
+    try:
+        response = session.get(endpoint, timeout=HEALTH_CHECK_TIMEOUT)
     except Exception:
         return False
     if response.status_code == 200:
@@ -28,12 +139,23 @@ def check_health_status():
     else:
         return False
 
-def run_report_server():
-    web_server = http.server.HTTPServer((HTTP_SERVER_HOST, HTTP_SERVER_PORT), http.server.SimpleHTTPRequestHandler)
+def wait_for_health(check, timeout, interval=1):
+    deadline = time.monotonic() + timeout
+    while True:
+        healthy = check()
+        if healthy or time.monotonic() >= deadline:
+            return healthy
+        time.sleep(min(interval, max(deadline - time.monotonic(), 0)))
+
+def get_health_latency(endpoint=LOCALSTACK_ENDPOINT, session=None):
+    if session is None:
+        import requests
+
+        session = requests
     try:
-        print(f"Starting webserver at: http://{HTTP_SERVER_HOST}:{HTTP_SERVER_PORT}")
-        web_server.serve_forever()
-    except KeyboardInterrupt:
-        pass
-    web_server.server_close()
-    print("Server stopped")
+        response = session.get(endpoint, timeout=HEALTH_CHECK_TIMEOUT)
+    except Exception:
+        return None
+    if response.status_code != 200:
+        return None
+    return response.elapsed.total_seconds()
@@ -0,0 +1,110 @@
+import subprocess
+import threading
+import time
+from colorama import Fore
+from constants import REPO_PATH, TEST_ENV_PARAMS, WARMUP_JOBS
+from utils import format_seconds, get_warmup_command
+
+
+class Warmup:
+    """Compiles the test packages of the selected services ahead of the run.
+
+    Packages are built in the background, `jobs` at a time, with `go test
+    -run '^$'` (or into the binary cache when one is used) so the Go build
+    cache is warm by the time their first test starts. No test is run; a
+    worker about to run a test of a service waits for that package only.
+    """
+
+    def __init__(self, services, jobs=WARMUP_JOBS, binary_cache=None):
+        self.services = list(dict.fromkeys(services))
+        self.jobs = max(1, jobs)
+        self.binary_cache = binary_cache
+        self.pending = list(self.services)
+        self.lock = threading.Lock()
+        self.compile_times = {}
+        self.failed = set()
+        self.events = {service: threading.Event() for service in self.services}
+        self.threads = []
+        self.start_time = None
+
+    def compile(self, service):
+        start = time.perf_counter()
+        try:
+            if self.binary_cache:
+                ok = self.binary_cache.get(service) is not None
+                output = ""
+            else:
+                result = subprocess.run(
+                    get_warmup_command(service),
+                    env=TEST_ENV_PARAMS,
+                    cwd=REPO_PATH,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                    text=True,
+                )
+                ok = result.returncode == 0
+                output = result.stdout
+        except Exception as error:
+            ok, output = False, str(error)
+        self.compile_times[service] = time.perf_counter() - start
+        compile_time = format_seconds(self.compile_times[service])
+        if ok:
+            print(f"{Fore.CYAN}[WARMUP] :: {service} - Compile Time: {compile_time}")
+        else:
+            # the tests of the package will fail with the same output
+            self.failed.add(service)
+            print(
+                f"{Fore.RED}[WARMUP] :: {service} - Failed after {compile_time}\n{output.strip()[-2000:]}"
+            )
+        self.events[service].set()
+
+    def work(self):
+        while True:
+            with self.lock:
+                if not self.pending:
+                    break
+                service = self.pending.pop(0)
+            self.compile(service)
+        with self.lock:
+            self.threads.remove(threading.current_thread())
+            if not self.threads:
+                self.print_summary()
+
+    def start(self):
+        print(
+            f"Warming up {len(self.services)} test packages, {self.jobs} at a time..."
+        )
+        self.start_time = time.perf_counter()
+        with self.lock:
+            for index in range(min(self.jobs, len(self.pending))):
+                thread = threading.Thread(
+                    target=self.work, name=f"warmup-{index + 1}", daemon=True
+                )
+                self.threads.append(thread)
+                thread.start()
+
+    def prioritize(self, services):
+        # compile in the order the scheduler will start services, and skip
+        # the packages left without selected tests
+        with self.lock:
+            skipped = [service for service in self.pending if service not in services]
+            self.pending = [service for service in services if service in self.pending]
+        for service in skipped:
+            self.events[service].set()
+
+    def wait(self, service=None):
+        if service is None:
+            for event in self.events.values():
+                event.wait()
+            return
+        event = self.events.get(service)
+        if event:
+            event.wait()
+
+    def print_summary(self):
+        if not self.compile_times:
+            return
+        slowest = max(self.compile_times, key=self.compile_times.get)
+        print(
+            f"Warm-up complete in {format_seconds(time.perf_counter() - self.start_time)}: {len(self.compile_times) - len(self.failed)}/{len(self.compile_times)} packages compiled, slowest {slowest} ({format_seconds(self.compile_times[slowest])})"
+        )